@@ -3,10 +3,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from django.shortcuts import redirect
+from mailings.views import MetricsView
 
 urlpatterns = [
    path('', lambda request: redirect('admin/')),
    path('api/broadcast/', include('mailings.urls')),
+   path('api/metrics/', MetricsView.as_view(), name='metrics'),
    path('admin/', admin.site.urls),
 ]
 
@@ -1,8 +1,9 @@
-import requests
+import logging
+import threading
 from django import forms
 from django.forms.models import ModelForm, ModelFormMetaclass, BaseInlineFormSet
 from django.contrib import admin
-from .api import get_filtered_users
+from .api import get_cached_users_count, prefetch_users_counts
 from django.utils.translation import gettext_lazy as _
 from unfold.admin import ModelAdmin, TabularInline
 from unfold.widgets import (
@@ -16,11 +17,17 @@ from unfold.widgets import (
 )
 from django.contrib import messages
 from django.core.exceptions import ValidationError
-from .models import Mailing, MailingMedia, MailingInlineButton, MailingBatch
+from .models import Mailing, MailingMedia, MailingInlineButton, MailingBatch, MailingFailure, MailingErrorStat, SuppressedUser
 from datetime import datetime, date
 from django.utils.html import format_html
-from .api import get_available_filters
-from django.db.models import Sum
+from .api import get_filters_schema
+from django.db.models import OuterRef, Subquery, Sum
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд страница списка рассылок ждет подсчета аудитории
+ADMIN_USERS_COUNT_TIMEOUT = getattr(settings, 'ADMIN_USERS_COUNT_TIMEOUT', 0.3)
 
 class MailingInlineButtonFormSet(BaseInlineFormSet):
     def __init__(self, *args, **kwargs):
@@ -59,6 +66,20 @@ class MailingMediaInline(TabularInline):
     verbose_name_plural = "Медиафайлы"
 
 
+class MailingErrorStatInline(TabularInline):
+    model = MailingErrorStat
+    extra = 0
+    can_delete = False
+    fields = ('error_code', 'count')
+    readonly_fields = ('error_code', 'count')
+    ordering = ('-count',)
+    verbose_name = "ошибка"
+    verbose_name_plural = "Ошибки доставки"
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class DynamicFieldsProcessor:
     @staticmethod
     def create_field_from_json(field_data):
@@ -125,60 +146,100 @@ class DynamicFieldsProcessor:
         )
 
 
-def create_dynamic_form():
-    json_data = get_available_filters()
+class MailingAdminForm(ModelForm):
+    class Meta:
+        model = Mailing
+        fields = '__all__'
+        widgets = {
+            'text': UnfoldAdminTextareaWidget,
+            'media_caption': UnfoldAdminTextareaWidget,
+        }
+
+    def clean(self):
+        cleaned_data = super().clean()
+        return cleaned_data
+
+    def __init__(self, *args, **kwargs):
+        instance = kwargs.get('instance')
+        super().__init__(*args, **kwargs)
+
+        if instance and instance.group_filters:
+            for field_name, value in instance.group_filters.items():
+                if field_name in self.fields:
+                    if isinstance(self.fields[field_name], forms.DateField) and isinstance(value, str):
+                        try:
+                            value = datetime.fromisoformat(value).date()
+                        except ValueError:
+                            pass
+                    elif isinstance(self.fields[field_name], forms.DateTimeField) and isinstance(value, str):
+                        try:
+                            value = datetime.fromisoformat(value)
+                        except ValueError:
+                            pass
+                    elif isinstance(self.fields[field_name], forms.ChoiceField) and value in [True, False]:
+                        value = str(value).lower()
+                    self.fields[field_name].initial = value
+
+
+def create_dynamic_form(json_data):
     json_fields = {
         field_data['name']: DynamicFieldsProcessor.create_field_from_json(field_data)
         for group in json_data['data']
         for field_data in group['fields']
     }
 
-    class MailingAdminForm(ModelForm):
-        class Meta:
-            model = Mailing
-            fields = '__all__'
-            widgets = {
-                'text': UnfoldAdminTextareaWidget,
-                'media_caption': UnfoldAdminTextareaWidget,
-            }
-
-        def clean(self):
-            cleaned_data = super().clean()
-            return cleaned_data
-
-        def __init__(self, *args, **kwargs):
-            instance = kwargs.get('instance')
-            super().__init__(*args, **kwargs)
-
-            if instance and instance.group_filters:
-                for field_name, value in instance.group_filters.items():
-                    if field_name in self.fields:
-                        if isinstance(self.fields[field_name], forms.DateField) and isinstance(value, str):
-                            try:
-                                value = datetime.fromisoformat(value).date()
-                            except ValueError:
-                                pass
-                        elif isinstance(self.fields[field_name], forms.DateTimeField) and isinstance(value, str):
-                            try:
-                                value = datetime.fromisoformat(value)
-                            except ValueError:
-                                pass
-                        elif isinstance(self.fields[field_name], forms.ChoiceField) and value in [True, False]:
-                            value = str(value).lower()
-                        self.fields[field_name].initial = value
-
     return ModelFormMetaclass('MailingAdminForm', (MailingAdminForm,), {**{'Meta': MailingAdminForm.Meta}, **json_fields})
 
 
+_dynamic_forms = {}
+_dynamic_forms_lock = threading.Lock()
+
+
+def get_dynamic_form(json_data, version):
+    """
+    Форма рассылки с полями фильтров, построенная один раз на каждую версию схемы.
+    """
+    form_class = _dynamic_forms.get(version)
+    if form_class is None:
+        with _dynamic_forms_lock:
+            form_class = _dynamic_forms.get(version)
+            if form_class is None:
+                form_class = create_dynamic_form(json_data)
+                _dynamic_forms[version] = form_class
+    return form_class
+
+
+def get_filters_schema_or_empty(request):
+    """
+    Схема фильтров для отображения страниц админки. Если сервер пользователей
+    недоступен и схемы нет в кэше, страница открывается без полей фильтров.
+    """
+    try:
+        return get_filters_schema()
+    except Exception as e:
+        if not getattr(request, '_filters_schema_warning', False):
+            request._filters_schema_warning = True
+            messages.warning(request, f'Не удалось загрузить фильтры пользователей: {str(e)}')
+        return {'data': []}, None
+
+
 @admin.register(Mailing)
 class MailingAdmin(ModelAdmin):
-    form = create_dynamic_form()
-    inlines = [MailingInlineButtonInline, MailingMediaInline]
+    form = MailingAdminForm
+    inlines = [MailingInlineButtonInline, MailingMediaInline, MailingErrorStatInline]
 
-    list_display = ('title', 'scheduled_at', 'status', 'created_by', 'created_at', 'delivery_stats', 'expected_users')
-    list_filter = ('status', 'scheduled_at', 'created_at')
+    list_display = ('title', 'scheduled_at', 'priority', 'status', 'created_by', 'created_at', 'delivery_stats', 'expected_users')
+    list_filter = ('status', 'priority', 'scheduled_at', 'created_at')
     search_fields = ('title', 'text')
-    readonly_fields = ('created_at', 'updated_at', 'created_by', 'error_message')
+    readonly_fields = (
+        'created_at', 'updated_at', 'created_by', 'error_message',
+        'lease_owner', 'lease_expires_at',
+        'batch_size', 'total_batches', 'last_dispatched_batch', 'dispatch_offset',
+        'audience_size', 'audience_position',
+        'successful_users_count', 'failed_users_count',
+    )
+
+    actions = ['restart_mailings']
 
     compressed_fields = True
     warn_unsaved_form = True
@@ -186,27 +247,75 @@ class MailingAdmin(ModelAdmin):
     list_fullwidth = True
     list_filter_sheet = True
 
+    @admin.action(description='Перезапустить рассылку')
+    def restart_mailings(self, request, queryset):
+        restarted = 0
+        for mailing in queryset.exclude(status=Mailing.Status.PROCESSING):
+            mailing.restart()
+            restarted += 1
+        skipped = queryset.count() - restarted
+        messages.success(request, f'Перезапущено рассылок: {restarted}')
+        if skipped:
+            messages.warning(request, f'Пропущено рассылок в процессе отправки: {skipped}')
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        changelist = f'{self.opts.app_label}_{self.opts.model_name}_changelist'
+        if getattr(request.resolver_match, 'url_name', None) != changelist:
+            return queryset
+        # Суммы по пакетам для рассылок, отправленных до появления счетчиков (только
+        # в списке). Подзапросы считаются для строк страницы, без GROUP BY по всем рассылкам
+        batches = MailingBatch.objects.filter(mailing=OuterRef('pk')).order_by().values('mailing')
+        return queryset.annotate(
+            batches_successful_users=Subquery(batches.annotate(total=Sum('successful_users')).values('total')),
+            batches_failed_users=Subquery(batches.annotate(total=Sum('failed_users')).values('total')),
+        )
+
     def delivery_stats(self, obj):
         total_successful = obj.total_successful_users
         total_failed = obj.total_failed_users
+        if not total_successful and not total_failed:
+            total_successful = getattr(obj, 'batches_successful_users', None) or 0
+            total_failed = getattr(obj, 'batches_failed_users', None) or 0
         total = total_successful + total_failed
         if total == 0:
             return '-'
         return f"{total_successful}/{total}"
     delivery_stats.short_description = 'Доставка'
 
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        # Количества для всех ожидающих рассылок страницы запрашиваются параллельно;
+        # не успевшие за ADMIN_USERS_COUNT_TIMEOUT досчитываются в фоне
+        prefetch_users_counts(
+            [
+                obj.group_filters for obj in changelist.result_list
+                if obj.status == Mailing.Status.PENDING and not obj.audience_expression
+            ],
+            timeout=ADMIN_USERS_COUNT_TIMEOUT
+        )
+        return changelist
+
     def expected_users(self, obj):
         if obj.status != 'pending':
             return '-'
-        try:
-            response = get_filtered_users(obj.group_filters, page=1, limit=1)
-            return response.get('count', 0)
-        except Exception as e:
-            return 0
+        if obj.audience_expression:
+            # Составная аудитория вычисляется только при отправке
+            return 'составная'
+        count = get_cached_users_count(obj.group_filters)
+        if count is None:
+            return 'вычисляется…'
+        return count
     expected_users.short_description = 'Кол-во'
 
+    def get_form(self, request, obj=None, **kwargs):
+        json_data, version = get_filters_schema_or_empty(request)
+        if version is not None:
+            kwargs['form'] = get_dynamic_form(json_data, version)
+        return super().get_form(request, obj, **kwargs)
+
     def get_fieldsets(self, request, obj=None):
-        json_data = get_available_filters()
+        json_data, version = get_filters_schema_or_empty(request)
 
         base_fieldsets = [
             ('Основное', {
@@ -218,7 +327,9 @@ class MailingAdmin(ModelAdmin):
                     'disable_notification',
                     'protect_content',
                     'scheduled_at',
+                    'priority',
                     'status',
+                    'audience_expression',
                 )
             }),
         ]
@@ -239,7 +350,17 @@ class MailingAdmin(ModelAdmin):
                     'created_at',
                     'updated_at',
                     'error_message',
-                    'group_filters'
+                    'group_filters',
+                    'lease_owner',
+                    'lease_expires_at',
+                    'batch_size',
+                    'total_batches',
+                    'last_dispatched_batch',
+                    'dispatch_offset',
+                    'audience_size',
+                    'audience_position',
+                    'successful_users_count',
+                    'failed_users_count',
                 ),
                 'classes': ('collapse',)
             })
@@ -248,7 +369,7 @@ class MailingAdmin(ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         try:
-            json_data = get_available_filters()
+            json_data, version = get_filters_schema()
             available_filter_names = []
             for group in json_data['data']:
                 available_filter_names.extend(field['name'] for field in group['fields'])
@@ -269,10 +390,22 @@ class MailingAdmin(ModelAdmin):
             obj.created_by = request.user
             super().save_model(request, obj, form, change)
 
+            # Возврат завершенной рассылки в ожидание - повторная отправка:
+            # без сброса контрольной точки и снимка обработчик решит,
+            # что отправлять больше некому
+            previous_status = form.initial.get('status')
+            if (
+                change
+                and obj.status == Mailing.Status.PENDING
+                and previous_status in (Mailing.Status.COMPLETED, Mailing.Status.FAILED)
+            ):
+                obj.restart()
+                messages.info(request, 'Рассылка будет отправлена заново всем пользователям')
+
         except ValidationError as e:
             messages.error(request, str(e))
         except Exception as e:
-            print(f"Error in save_model: {str(e)}")
+            logger.error("Error in save_model: %s", e)
             raise
 
 
@@ -388,7 +521,33 @@ class MailingMediaAdmin(ModelAdmin):
         }
 @admin.register(MailingBatch)
 class MailingBatchAdmin(ModelAdmin):
-    list_display = ['mailing', 'batch_number', 'successful_users', 'failed_users', 'created_at']
+    list_display = ['mailing', 'batch_number', 'successful_users', 'failed_users', 'sent_at', 'reported_at']
     list_filter = ['mailing', 'created_at']
     search_fields = ['mailing__title']
-    readonly_fields = ['mailing', 'batch_number', 'successful_users', 'failed_users', 'error_details', 'created_at']
+    readonly_fields = ['mailing', 'batch_number', 'successful_users', 'failed_users', 'sent_at', 'reported_at', 'created_at']
+
+
+@admin.register(MailingFailure)
+class MailingFailureAdmin(ModelAdmin):
+    list_display = ['mailing', 'batch_number', 'user_id', 'error_code', 'error_text']
+    list_filter = ['error_code']
+    search_fields = ['=user_id', 'mailing__title']
+    readonly_fields = ['mailing', 'batch_number', 'user_id', 'error_code', 'error_text']
+    raw_id_fields = ['mailing']
+    list_select_related = ['mailing']
+    show_full_result_count = False
+
+
+@admin.register(SuppressedUser)
+class SuppressedUserAdmin(ModelAdmin):
+    """
+    Удаление записи возвращает пользователя в рассылки до следующей постоянной ошибки.
+    """
+    list_display = ['user_id', 'error_code', 'failed_at']
+    list_filter = ['error_code']
+    search_fields = ['=user_id']
+    readonly_fields = ['user_id', 'error_code', 'failed_at']
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
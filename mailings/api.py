@@ -1,13 +1,130 @@
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
 import requests
-from typing import Optional, List, Dict, Any
+from collections import deque
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional, List, Dict, Any, Iterator, Tuple, Callable
 from django.conf import settings
+from django.core.cache import cache
+from . import http_client
+from .metrics import upstream_request
+
+logger = logging.getLogger(__name__)
 
 AUTH_URL = getattr(settings, 'AUTH_URL', '')                
 AUTH_KEY = getattr(settings, 'AUTH_KEY', '')
 AUTH_PROVIDER = getattr(settings, 'AUTH_PROVIDER', '')
 AUTH_PASSWORD = getattr(settings, 'AUTH_PASSWORD', '')
 
-def auth_request() -> str:
+# Время жизни токена, если сервер не вернул exp в JWT (секунды)
+AUTH_TOKEN_TTL = getattr(settings, 'AUTH_TOKEN_TTL', 300)
+# За сколько секунд до истечения токена начинать его обновление
+AUTH_TOKEN_REFRESH_MARGIN = getattr(settings, 'AUTH_TOKEN_REFRESH_MARGIN', 30)
+
+# Максимальное число одновременных запросов страниц пользователей
+USERS_FETCH_CONCURRENCY = getattr(settings, 'USERS_FETCH_CONCURRENCY', 4)
+
+# Время жизни закэшированного количества пользователей по фильтрам (секунды)
+USERS_COUNT_CACHE_TTL = getattr(settings, 'USERS_COUNT_CACHE_TTL', 300)
+
+# Сколько секунд схема доступных фильтров считается свежей; устаревшая схема
+# отдается сразу, а обновляется в фоне
+FILTERS_SCHEMA_CACHE_TTL = getattr(settings, 'FILTERS_SCHEMA_CACHE_TTL', 600)
+
+
+def _token_expires_at(token: str) -> float:
+    """
+    Возвращает время истечения токена (unix timestamp).
+    Берет exp из payload JWT, иначе использует AUTH_TOKEN_TTL.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return float(exp)
+    except (IndexError, ValueError, AttributeError, TypeError):
+        pass
+    return time.time() + AUTH_TOKEN_TTL
+
+
+class TokenManager:
+    """
+    Хранит токен авторизации на уровне процесса.
+
+    Токен обновляется заранее (за AUTH_TOKEN_REFRESH_MARGIN секунд до истечения),
+    при этом логин выполняет только один поток: остальные либо продолжают
+    пользоваться еще действующим токеном, либо ждут результата обновления.
+    """
+
+    def __init__(self, refresh_margin: float = AUTH_TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_token(self, force_refresh: bool = False) -> str:
+        token, expires_at = self._token, self._expires_at
+        now = time.time()
+
+        if token and not force_refresh:
+            if now < expires_at - self.refresh_margin:
+                return token
+            if now < expires_at:
+                # Токен еще действует: обновляем его, только если никто другой
+                # уже не занимается обновлением
+                if not self._lock.acquire(blocking=False):
+                    return token
+                try:
+                    return self._refresh(stale_token=token)
+                finally:
+                    self._lock.release()
+
+        with self._lock:
+            return self._refresh(stale_token=token)
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """
+        Сбрасывает токен (например, после ответа 401).
+        Если передан token, сбрасывает только если он все еще текущий.
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0.0
+
+    def _refresh(self, stale_token: Optional[str]) -> str:
+        # Пока мы ждали блокировку, токен мог обновить другой поток
+        if self._token and self._token != stale_token and time.time() < self._expires_at - self.refresh_margin:
+            return self._token
+
+        token = _login_request()
+        self._token = token
+        self._expires_at = _token_expires_at(token)
+        return token
+
+
+token_manager = TokenManager()
+
+
+def auth_request(force_refresh: bool = False) -> str:
+    """
+    Возвращает действующий токен авторизации.
+    Логин выполняется только при отсутствии токена или при его скором истечении.
+        
+    Returns:
+        str: token из ответа сервера
+    """
+    return token_manager.get_token(force_refresh=force_refresh)
+
+
+@upstream_request('auth')
+def _login_request() -> str:
     """
     POST запрос для авторизации
         
@@ -26,7 +143,7 @@ def auth_request() -> str:
     }
     
     try:
-        response = requests.post(
+        response = http_client.post(
             url=f"{AUTH_URL}/auth/login",
             json=payload,
             headers=headers
@@ -39,9 +156,28 @@ def auth_request() -> str:
         raise Exception(f"Ошибка авторизации: {error_data}")
                 
     except Exception as e:
-        print(f"Ошибка при выполнении запроса на авторизацию: {str(e)}")
+        logger.error("Ошибка при выполнении запроса на авторизацию: %s", e)
         raise
 
+
+def _authorized_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Выполняет запрос с Bearer-токеном.
+    При ответе 401 сбрасывает токен, авторизуется заново и повторяет запрос один раз.
+    """
+    for attempt in range(2):
+        token = auth_request()
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        response = http_client.request(method, url, headers=headers, **kwargs)
+        if response.status_code != 401:
+            return response
+        token_manager.invalidate(token)
+    return response
+
+@upstream_request('available_filters')
 def get_available_filters() -> List[Dict[str, Any]]:
     """
     GET запрос для получения доступных фильтров
@@ -55,17 +191,10 @@ def get_available_filters() -> List[Dict[str, Any]]:
             "choices": List[str]
         }
     """
-    token = auth_request()
-    
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    
     try:
-        response = requests.get(
-            url=f"{AUTH_URL}/users/available-filters",
-            headers=headers
+        response = _authorized_request(
+            "GET",
+            url=f"{AUTH_URL}/users/available-filters"
         )
         
         if response.status_code == 200:
@@ -75,17 +204,86 @@ def get_available_filters() -> List[Dict[str, Any]]:
         raise Exception(f"Ошибка получения фильтров: {error_data}")
             
     except Exception as e:
-        print(f"Ошибка при выполнении запроса фильтров: {str(e)}")
+        logger.error("Ошибка при выполнении запроса фильтров: %s", e)
         raise
 
+class FiltersSchemaCache:
+    """
+    Кэш схемы доступных фильтров (ответ /users/available-filters).
+
+    Схема хранится в памяти процесса и в кэше Django (общем для процессов).
+    Каждой схеме присваивается версия - хэш ее содержимого, по которой
+    можно кэшировать построенные на ее основе объекты (формы админки).
+    Если схема старше FILTERS_SCHEMA_CACHE_TTL, она возвращается как есть,
+    а обновление запускается в фоновом потоке.
+    """
+
+    cache_key = 'mailings:filters_schema'
+
+    def __init__(self, ttl: float = FILTERS_SCHEMA_CACHE_TTL):
+        self.ttl = ttl
+        self._entry: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self) -> Tuple[Dict[str, Any], str]:
+        """
+        Returns:
+            Tuple[Dict, str]: схема фильтров и ее версия
+
+        Raises:
+            Exception: если схемы нет ни в одном кэше и сервер недоступен
+        """
+        entry = self._entry or cache.get(self.cache_key)
+        if entry is None:
+            entry = self.refresh()
+        else:
+            self._entry = entry
+            if time.time() - entry['fetched_at'] > self.ttl:
+                self._refresh_in_background()
+        return entry['schema'], entry['version']
+
+    def refresh(self) -> Dict[str, Any]:
+        schema = get_available_filters()
+        canonical = json.dumps(schema, sort_keys=True, ensure_ascii=False)
+        entry = {
+            'schema': schema,
+            'version': hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16],
+            'fetched_at': time.time(),
+        }
+        self._entry = entry
+        cache.set(self.cache_key, entry, None)
+        return entry
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Ошибка фонового обновления схемы фильтров: %s", e)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='filters-schema-refresh', daemon=True).start()
+
+
+filters_schema_cache = FiltersSchemaCache()
+
+
+def get_filters_schema() -> Tuple[Dict[str, Any], str]:
+    """
+    Схема доступных фильтров и ее версия из кэша (см. FiltersSchemaCache).
+    """
+    return filters_schema_cache.get()
+
+
+@upstream_request('users_filter')
 def get_filtered_users(filters: Dict[str, Any], page: int = 1, limit: int = 100) -> Dict[str, Any]:
-    token = auth_request()
-    
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    
     params = {
         "page": page,
         "limit": limit
@@ -96,11 +294,11 @@ def get_filtered_users(filters: Dict[str, Any], page: int = 1, limit: int = 100)
     }
     
     try:
-        response = requests.post(
+        response = _authorized_request(
+            "POST",
             url=f"{AUTH_URL}/users/filter",
             json=request_data,
-            params=params,
-            headers=headers
+            params=params
         )
         
         if response.status_code == 201:
@@ -113,5 +311,170 @@ def get_filtered_users(filters: Dict[str, Any], page: int = 1, limit: int = 100)
         raise Exception(f"Ошибка получения пользователей: {error_data}")
             
     except Exception as e:
-        print(f"Ошибка при выполнении запроса пользователей: {str(e)}")
-        raise
\ No newline at end of file
+        logger.error("Ошибка при выполнении запроса пользователей: %s", e)
+        raise
+
+
+def iter_filtered_users(
+    filters: Dict[str, Any],
+    page_size: int = 100,
+    concurrency: int = USERS_FETCH_CONCURRENCY,
+    total_count: Optional[int] = None,
+    start_page: int = 1,
+    fetch: Optional[Callable[..., Dict[str, Any]]] = None
+) -> Iterator[Tuple[int, List[Any]]]:
+    """
+    Загружает страницы пользователей параллельно и отдает их по порядку.
+
+    Одновременно выполняется не больше concurrency запросов: следующая страница
+    запрашивается, только когда потребитель забрал очередную готовую.
+    Если total_count не передан, он запрашивается отдельным запросом с limit=1.
+    fetch заменяет get_filtered_users для загрузки страниц (например, чтобы
+    замерять время ответа).
+
+    Yields:
+        Tuple[int, List]: номер страницы и список пользователей на ней
+    """
+    if total_count is None:
+        total_count = get_filtered_users(filters, page=1, limit=1).get('count', 0)
+    total_pages = (total_count + page_size - 1) // page_size
+    if start_page > total_pages:
+        return
+
+    fetch = fetch or get_filtered_users
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='users-fetch')
+    pending = deque()
+    next_page = start_page
+
+    def submit():
+        nonlocal next_page
+        future = executor.submit(fetch, filters, page=next_page, limit=page_size)
+        pending.append((next_page, future))
+        next_page += 1
+
+    try:
+        while next_page <= total_pages and len(pending) < concurrency:
+            submit()
+
+        while pending:
+            page, future = pending.popleft()
+            users = future.result().get('users', [])
+            if next_page <= total_pages:
+                submit()
+            yield page, users
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _canonical_value(value: Any) -> Any:
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, set)):
+        items = {json.dumps(_canonical_value(item), sort_keys=True, ensure_ascii=False) for item in value}
+        return [json.loads(item) for item in sorted(items)]
+    if isinstance(value, dict):
+        return canonical_filters(value)
+    if isinstance(value, str):
+        if value in ('True', 'False'):
+            return value.lower()
+        if '-' in value:
+            parse = date.fromisoformat if len(value) == 10 else datetime.fromisoformat
+            try:
+                return parse(value).isoformat()
+            except ValueError:
+                pass
+        return value
+    return str(value)
+
+
+def canonical_filters(filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Приводит фильтры к каноническому виду, как их сохраняет MailingAdmin.save_model:
+    пустые значения отбрасываются, bool - 'true'/'false', даты - ISO формат,
+    числа - строки, списки сортируются без повторов.
+    """
+    return {
+        key: _canonical_value(value)
+        for key, value in (filters or {}).items()
+        if value not in (None, '', [], {})
+    }
+
+
+def filters_hash(filters: Optional[Dict[str, Any]]) -> str:
+    """
+    Канонический хэш набора фильтров: не зависит от порядка ключей и элементов
+    списков и от способа записи значений (см. canonical_filters).
+    """
+    canonical = json.dumps(canonical_filters(filters), sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _users_count_cache_key(filters: Optional[Dict[str, Any]]) -> str:
+    return f'mailings:users_count:{filters_hash(filters)}'
+
+
+def get_cached_users_count(filters: Optional[Dict[str, Any]]) -> Optional[int]:
+    """
+    Количество пользователей по фильтрам из кэша, без запроса к серверу.
+    """
+    return cache.get(_users_count_cache_key(filters))
+
+
+def get_users_count(filters: Optional[Dict[str, Any]]) -> int:
+    """
+    Количество пользователей по фильтрам. Результат кэшируется на USERS_COUNT_CACHE_TTL секунд.
+    """
+    key = _users_count_cache_key(filters)
+    count = cache.get(key)
+    if count is None:
+        count = get_filtered_users(filters or {}, page=1, limit=1).get('count', 0)
+        cache.set(key, count, USERS_COUNT_CACHE_TTL)
+    return count
+
+
+_count_executor = ThreadPoolExecutor(max_workers=USERS_FETCH_CONCURRENCY, thread_name_prefix='users-count')
+_count_futures: Dict[str, Any] = {}
+_count_futures_lock = threading.Lock()
+
+
+def prefetch_users_counts(filters_list: List[Optional[Dict[str, Any]]], timeout: Optional[float] = None) -> Dict[str, int]:
+    """
+    Параллельно загружает в кэш количества пользователей для нескольких наборов фильтров.
+
+    Ждет не дольше timeout секунд: запросы, не успевшие завершиться, продолжают
+    выполняться в фоне и попадут в кэш позже. Одинаковые фильтры запрашиваются один раз.
+
+    Returns:
+        Dict[str, int]: количества, известные к моменту возврата, по filters_hash
+    """
+    counts = {}
+    futures = []
+
+    for filters in filters_list:
+        digest = filters_hash(filters)
+        if digest in counts:
+            continue
+        count = get_cached_users_count(filters)
+        if count is not None:
+            counts[digest] = count
+            continue
+
+        with _count_futures_lock:
+            future = _count_futures.get(digest)
+            if future is None or future.done():
+                future = _count_executor.submit(get_users_count, filters)
+                _count_futures[digest] = future
+                future.add_done_callback(lambda f, digest=digest: _count_futures.pop(digest, None))
+        futures.append((digest, future))
+
+    if futures:
+        wait([future for _, future in futures], timeout=timeout)
+
+    for digest, future in futures:
+        if future.done() and not future.exception():
+            counts[digest] = future.result()
+    return counts
@@ -1,14 +1,63 @@
 from django.apps import AppConfig
+from django.conf import settings
+import logging
+import os
+import sys
 import threading
 
 
+def _should_start_dispatcher():
+    """
+    Встроенный обработчик рассылок запускается только в процессах, обслуживающих
+    запросы (gunicorn, runserver), и только если он не отключен настройкой
+    MAILING_DISPATCHER_IN_PROCESS (например, при запуске отдельного check_mailings).
+    """
+    if not getattr(settings, 'MAILING_DISPATCHER_IN_PROCESS', True):
+        return False
+
+    if os.path.basename(sys.argv[0]) in ('manage.py', 'django-admin'):
+        if len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+            return False
+        # Процесс-наблюдатель автоперезагрузки runserver рассылки не отправляет
+        if '--noreload' not in sys.argv and os.environ.get('RUN_MAIN') != 'true':
+            return False
+
+    return True
+
+
+def _configure_logging():
+    """
+    Если логирование в проекте не настроено (у корневого логгера нет обработчиков
+    и в LOGGING нет логгера mailings), выводим сообщения mailings в stderr
+    с уровнем MAILING_LOG_LEVEL (DEBUG включает содержимое пакетов).
+    Сообщения по-прежнему передаются корневому логгеру.
+    """
+    logger = logging.getLogger('mailings')
+    if 'mailings' in getattr(settings, 'LOGGING', {}).get('loggers', {}) or logger.handlers:
+        return
+    if logging.getLogger().handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(getattr(settings, 'MAILING_LOG_LEVEL', 'INFO'))
+
+
 class MailingsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mailings'
     verbose_name = 'Сообщения'
 
     def ready(self):
-        from mailings.management.commands.check_mailings import check_mailings_daemon
+        _configure_logging()
+
+        # Подключаем обработчики сигналов
+        from mailings import signals
+
+        if not _should_start_dispatcher():
+            return
+
+        from mailings.dispatcher import check_mailings_daemon
         
         # Запускаем проверку рассылок в отдельном потоке
         mailing_thread = threading.Thread(target=check_mailings_daemon, daemon=True)
@@ -0,0 +1,172 @@
+import heapq
+import os
+import uuid
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .api import filters_hash, iter_filtered_users
+from .id_store import data_path
+from .models import Mailing, MailingFailure
+from .segment_cache import segment_cache
+from .snapshot import AudienceSnapshot, MAILING_SNAPSHOT_PAGE_SIZE, iter_sent_ids, sent_ids_path
+
+
+def union(*sources: Iterable[int]) -> Iterator[int]:
+    """
+    Объединение возрастающих последовательностей id (без повторов).
+    """
+    previous = None
+    for user_id in heapq.merge(*sources):
+        if user_id != previous:
+            previous = user_id
+            yield user_id
+
+
+def _intersect_two(left: Iterable[int], right: Iterable[int]) -> Iterator[int]:
+    left, right = iter(left), iter(right)
+    a = next(left, None)
+    b = next(right, None)
+    while a is not None and b is not None:
+        if a < b:
+            a = next(left, None)
+        elif b < a:
+            b = next(right, None)
+        else:
+            yield a
+            a = next(left, None)
+            b = next(right, None)
+
+
+def intersection(first: Iterable[int], *others: Iterable[int]) -> Iterator[int]:
+    """
+    Пересечение возрастающих последовательностей id.
+    """
+    result = iter(first)
+    for other in others:
+        result = _intersect_two(result, other)
+    return result
+
+
+def difference(source: Iterable[int], excluded: Iterable[int]) -> Iterator[int]:
+    """
+    id из source, которых нет в excluded (обе последовательности возрастают).
+    """
+    excluded = iter(excluded)
+    b = next(excluded, None)
+    for a in source:
+        while b is not None and b < a:
+            b = next(excluded, None)
+        if a != b:
+            yield a
+
+
+def resolve_filters(filters: Dict[str, Any], snapshot: AudienceSnapshot) -> Tuple[int, str]:
+    """
+    Записывает в snapshot пользователей, подходящих под фильтры.
+
+    Сегмент с теми же фильтрами (по filters_hash), выбранный
+    не раньше MAILING_SEGMENT_CACHE_TTL секунд назад, берется из segment_cache
+    без обращения к /users/filter.
+
+    Returns:
+        Tuple[int, str]: количество пользователей и источник ('кэш сегментов' или '/users/filter')
+    """
+    segment_key = filters_hash(filters)
+    with segment_cache.lock(segment_key):
+        if segment_cache.get(segment_key, snapshot.path):
+            return len(snapshot), 'кэш сегментов'
+        pages = iter_filtered_users(filters, page_size=MAILING_SNAPSHOT_PAGE_SIZE)
+        audience_size = snapshot.build(users for _, users in pages)
+        segment_cache.put(segment_key, snapshot.path)
+        return audience_size, '/users/filter'
+
+
+def mailing_recipients(mailing_id: int, sent: AudienceSnapshot) -> Iterator[int]:
+    """
+    Получатели прошлой рассылки: пользователи из пакетов, принятых ботом
+    (журнал append_sent_ids, сортируется во временный снимок sent),
+    без пользователей, доставка которым завершилась ошибкой.
+
+    Для рассылок, отправленных до появления журнала, берется отправленная
+    часть снимка аудитории (до audience_position); исключенные при отправке
+    пользователи (список подавления, ограничение частоты) в ней остаются.
+    """
+    mailing = Mailing.objects.filter(pk=mailing_id).values('audience_position', 'snapshot_generation').first()
+    if mailing is None:
+        raise ValueError(f'Рассылка {mailing_id} не найдена')
+    generation = mailing['snapshot_generation']
+
+    if os.path.exists(sent_ids_path(mailing_id, generation)):
+        sent.build(iter_sent_ids(mailing_id, generation))
+        recipients = iter(sent)
+    else:
+        snapshot = AudienceSnapshot.for_mailing(mailing_id, generation)
+        if not snapshot.exists():
+            raise ValueError(f'Снимок аудитории рассылки {mailing_id} не найден')
+        recipients = islice(iter(snapshot), mailing['audience_position'])
+
+    failed = (
+        MailingFailure.objects
+        .filter(mailing_id=mailing_id)
+        .order_by('user_id')
+        .values_list('user_id', flat=True)
+        .distinct()
+        .iterator(chunk_size=10000)
+    )
+    return difference(recipients, failed)
+
+
+class AudienceExpression:
+    """
+    Вычисление составной аудитории (Mailing.audience_expression) локально,
+    потоковыми операциями над отсортированными массивами id в файлах.
+
+    Каждый лист с фильтрами выбирается через resolve_filters (а значит,
+    из кэша сегментов, если он свежий) во временный снимок, который
+    удаляется после вычисления.
+    """
+
+    def __init__(self, default_filters: Optional[Dict[str, Any]] = None):
+        self.default_filters = default_filters or {}
+        self._temporary: List[AudienceSnapshot] = []
+
+    def _temporary_snapshot(self) -> AudienceSnapshot:
+        snapshot = AudienceSnapshot(data_path('tmp', f'{uuid.uuid4().hex}.bin'))
+        self._temporary.append(snapshot)
+        return snapshot
+
+    def _leaf_filters(self, filters: Optional[Dict[str, Any]]) -> Iterator[int]:
+        snapshot = self._temporary_snapshot()
+        resolve_filters(self.default_filters if filters is None else filters, snapshot)
+        return iter(snapshot)
+
+    def _evaluate(self, node: Dict[str, Any]) -> Iterator[int]:
+        operator, operand = next(iter(node.items()))
+        if operator == 'filters':
+            return self._leaf_filters(operand)
+        if operator == 'mailing':
+            return mailing_recipients(operand, self._temporary_snapshot())
+
+        sources = [self._evaluate(child) for child in operand]
+        if operator == 'union':
+            return union(*sources)
+        if operator == 'intersect':
+            return intersection(*sources)
+        # exclude: первый операнд без всех остальных
+        if len(sources) == 1:
+            return sources[0]
+        return difference(sources[0], union(*sources[1:]))
+
+    def write(self, expression: Dict[str, Any], snapshot: AudienceSnapshot) -> int:
+        """
+        Вычисляет выражение и записывает результат в snapshot.
+
+        Returns:
+            int: количество пользователей
+        """
+        try:
+            return snapshot.write(self._evaluate(expression))
+        finally:
+            for temporary in self._temporary:
+                temporary.delete()
+            self._temporary = []
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from django.conf import settings
+
+# Начальный размер пакета пользователей /broadcast
+MAILING_BATCH_SIZE = getattr(settings, 'MAILING_BATCH_SIZE', 100)
+# Границы, в которых подбирается размер пакета
+MAILING_BATCH_SIZE_MIN = getattr(settings, 'MAILING_BATCH_SIZE_MIN', 50)
+MAILING_BATCH_SIZE_MAX = getattr(settings, 'MAILING_BATCH_SIZE_MAX', 1000)
+# Шаг увеличения после быстрого успешного запроса
+MAILING_BATCH_SIZE_STEP = getattr(settings, 'MAILING_BATCH_SIZE_STEP', 50)
+# Во сколько раз уменьшать размер при ошибке или медленном ответе
+MAILING_BATCH_SIZE_DECREASE = getattr(settings, 'MAILING_BATCH_SIZE_DECREASE', 0.5)
+
+# Время ответа /broadcast (секунды), выше которого бот считается перегруженным
+MAILING_BROADCAST_TARGET_LATENCY = getattr(settings, 'MAILING_BROADCAST_TARGET_LATENCY', 2.0)
+
+
+class AdaptiveBatchSize:
+    """
+    Размер пакета, подбираемый по принципу AIMD: после каждого быстрого
+    успешного запроса /broadcast увеличивается на step, после временной ошибки
+    бота или ответа медленнее target уменьшается в 1/decrease раз.
+    Учитываются только запросы к боту: время ответа сервиса пользователей
+    не говорит о том, сколько бот успевает принять.
+
+    Запросы выполняются параллельно, поэтому на одну перегрузку приходится
+    несколько медленных ответов. Уменьшение учитывается только для запросов,
+    начатых после предыдущего уменьшения, чтобы размер не падал сразу до минимума.
+    """
+
+    def __init__(
+        self,
+        initial=MAILING_BATCH_SIZE,
+        minimum=MAILING_BATCH_SIZE_MIN,
+        maximum=MAILING_BATCH_SIZE_MAX,
+        step=MAILING_BATCH_SIZE_STEP,
+        decrease=MAILING_BATCH_SIZE_DECREASE,
+        target=MAILING_BROADCAST_TARGET_LATENCY
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.step = step
+        self.decrease = decrease
+        self.target = target
+        self._size = self._clamp(initial)
+        self._decreased_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def _clamp(self, size):
+        return int(min(self.maximum, max(self.minimum, size)))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def record(self, started_at: float, latency: float, ok: bool) -> int:
+        """
+        Учитывает результат одной попытки отправки пакета в /broadcast;
+        ok=False - временная ошибка бота (5xx, 429, обрыв соединения).
+
+        Returns:
+            int: новый размер пакета
+        """
+        with self._lock:
+            if ok and latency <= self.target:
+                self._size = self._clamp(self._size + self.step)
+            elif started_at >= self._decreased_at:
+                self._size = self._clamp(self._size * self.decrease)
+                self._decreased_at = time.monotonic()
+            return self._size
+
+
+# Общий для процесса: состояние бота не зависит от рассылки
+batch_sizer = AdaptiveBatchSize()
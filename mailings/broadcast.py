@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import Any, Dict, List
+
+from django.conf import settings
+
+from . import http_client
+from .metrics import upstream_request
+
+logger = logging.getLogger(__name__)
+
+# Регистрировать сообщения рассылки в боте один раз и передавать в пакетах
+# только ссылку на них. Если бот не поддерживает /payloads, сообщения
+# передаются в каждом пакете, как раньше.
+BROADCAST_PAYLOAD_REFERENCES = getattr(settings, 'BROADCAST_PAYLOAD_REFERENCES', True)
+
+# Ответы бота, означающие, что регистрация сообщений не поддерживается
+_UNSUPPORTED_STATUSES = (404, 405, 501)
+# Ответы /broadcast, с которыми бот может сообщить, что не знает payload_id
+# (например, потерял зарегистрированные сообщения после перезапуска)
+_UNKNOWN_PAYLOAD_STATUSES = (404, 409, 410, 422)
+
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class BroadcastPayload:
+    """
+    Сообщения рассылки, сериализованные в JSON один раз.
+
+    payload_id - SHA-256 сериализованных сообщений, поэтому регистрация
+    идемпотентна: PUT /payloads/{payload_id} можно безопасно повторять,
+    а изменившиеся сообщения (например, после получения file_id) получают новый id.
+    Тело каждого пакета собирается склейкой готовых байтов.
+
+    Если бот отвечает на пакет, что не знает payload_id, регистрация
+    сбрасывается (forget) и выполняется заново при сборке следующего тела.
+    """
+
+    def __init__(self, broadcast_id: str, messages: List[Dict[str, Any]], delay_between_users: int = 0):
+        self.broadcast_id = str(broadcast_id)
+        self.delay_between_users = delay_between_users
+        self.messages_json = _dumps(messages)
+        self.payload_id = hashlib.sha256(self.messages_json).hexdigest()
+        self._registered = None
+        self._lock = threading.Lock()
+
+    def register(self) -> bool:
+        """
+        Регистрирует сообщения в боте (один раз на объект).
+
+        Returns:
+            bool: True, если пакеты можно отправлять со ссылкой на payload_id
+        """
+        if self._registered is not None:
+            return self._registered
+
+        with self._lock:
+            if self._registered is None:
+                if not BROADCAST_PAYLOAD_REFERENCES:
+                    self._registered = False
+                else:
+                    with upstream_request('payloads'):
+                        response = http_client.put(
+                            f'{settings.BROADCAST_URL}/payloads/{self.payload_id}',
+                            data=b'{"broadcast_id":' + _dumps(self.broadcast_id) + b',"messages":' + self.messages_json + b'}',
+                            headers={'Content-Type': 'application/json'}
+                        )
+                    if response.status_code in _UNSUPPORTED_STATUSES:
+                        logger.warning(
+                            "Бот не поддерживает регистрацию сообщений (%s), сообщения передаются в каждом пакете",
+                            response.status_code
+                        )
+                        self._registered = False
+                    elif 200 <= response.status_code < 300:
+                        self._registered = True
+                    else:
+                        raise Exception(f"Ошибка регистрации сообщений рассылки: {response.status_code} {response.text[:500]}")
+        return self._registered
+
+    def is_unknown_payload(self, response) -> bool:
+        """
+        Проверяет, отклонил ли бот пакет из-за незнакомого payload_id.
+        """
+        return (
+            self._registered is True
+            and response.status_code in _UNKNOWN_PAYLOAD_STATUSES
+            and 'payload' in response.text.lower()
+        )
+
+    def forget(self) -> None:
+        """
+        Сбрасывает регистрацию: следующий пакет зарегистрирует сообщения заново.
+        """
+        with self._lock:
+            self._registered = None
+
+    def batch_body(self, user_ids: List[Any], batch_number: int, total_batches: int) -> bytes:
+        if self.register():
+            head = b'{"payload_id":' + _dumps(self.payload_id)
+        else:
+            head = b'{"messages":' + self.messages_json
+        return b''.join((
+            head,
+            b',"user_ids":', _dumps(user_ids),
+            b',"delay_between_users":', _dumps(self.delay_between_users),
+            b',"batch_number":', _dumps(batch_number),
+            b',"total_batches":', _dumps(total_batches),
+            b',"broadcast_id":', _dumps(self.broadcast_id),
+            b'}',
+        ))
@@ -0,0 +1,603 @@
+from .models import Mailing, MailingBatch, MailingMedia
+from .telegram_utils import create_text_message, prepare_media_messages
+from .scheduler import ScheduleListener, scheduler
+from .suppression import MAILING_SUPPRESSION_ENABLED, suppression_list
+from .broadcast import BroadcastPayload
+from .batch_sizer import batch_sizer
+from .fair_queue import send_queue
+from .snapshot import AudienceSnapshot, append_sent_ids, delete_stale_generations
+from .audience import AudienceExpression, resolve_filters
+from .frequency import delivery_index, save_batch_ids
+from .metrics import (
+    batches_sent, stage_seconds, upstream_request, users_sent, users_skipped
+)
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+from datetime import timedelta
+import logging
+import os
+import random
+import requests
+import socket
+import time
+import threading
+import uuid
+from . import http_client
+
+# Время аренды рассылки обработчиком (секунды); продлевается каждые треть срока
+MAILING_LEASE_SECONDS = getattr(settings, 'MAILING_LEASE_SECONDS', 120)
+
+# Как часто проверять, сообщил ли бот file_id загруженных медиафайлов (секунды)
+MAILING_FILE_ID_CHECK_INTERVAL = getattr(settings, 'MAILING_FILE_ID_CHECK_INTERVAL', 1)
+
+# Количество потоков обработчика, параллельно отправляющих разные рассылки;
+# пакеты одновременных рассылок чередуются в общей очереди send_queue
+MAILING_DISPATCHER_WORKERS = getattr(settings, 'MAILING_DISPATCHER_WORKERS', 4)
+# Максимальное время сна потока обработчика без сигналов (секунды)
+MAILING_DISPATCHER_POLL_TIMEOUT = getattr(settings, 'MAILING_DISPATCHER_POLL_TIMEOUT', 60)
+
+# Повторы пакета /broadcast при временных ошибках бота (5xx, 429, обрыв соединения).
+# Повтор идет с тем же заголовком Idempotency-Key, по которому бот отбрасывает
+# пакет, уже принятый до ошибки
+MAILING_BROADCAST_RETRIES = getattr(settings, 'MAILING_BROADCAST_RETRIES', 4)
+# Пауза перед первым повтором (секунды); удваивается с каждым следующим
+MAILING_BROADCAST_RETRY_BACKOFF = getattr(settings, 'MAILING_BROADCAST_RETRY_BACKOFF', 1.0)
+MAILING_BROADCAST_RETRY_BACKOFF_MAX = getattr(settings, 'MAILING_BROADCAST_RETRY_BACKOFF_MAX', 10.0)
+# Ответы /broadcast, после которых пакет можно повторить
+BROADCAST_TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+# Через сколько секунд снова взять рассылку, прерванную временной ошибкой бота
+# или сервиса пользователей (отправка продолжится с контрольной точки)
+MAILING_TRANSIENT_RETRY_DELAY = getattr(settings, 'MAILING_TRANSIENT_RETRY_DELAY', 60)
+
+# Идентификатор обработчика в аренде рассылки
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+logger = logging.getLogger(__name__)
+
+
+@stage_seconds.time(stage='payload_build')
+def get_mailing_data(mailing):
+    messages = []
+    # Медиафайлы, для которых бот еще не сообщил file_id
+    awaiting_file_ids = []
+
+    if mailing.media_files.exists():
+        media_files = mailing.media_files.all()
+        media_messages = prepare_media_messages(media_files)
+        messages.extend(media_messages)
+        awaiting_file_ids = [media.pk for media in media_files if not media.telegram_file_id]
+
+    if mailing.text and mailing.text.strip():
+        messages.append(create_text_message(mailing))
+
+    data = {
+        'messages': messages,
+        'user_ids': [],
+        'delay_between_users': 0,
+        'payload': BroadcastPayload(mailing.pk, messages, delay_between_users=0),
+        'awaiting_file_ids': awaiting_file_ids,
+        'checked_at': time.monotonic()
+    }
+    return data
+
+def refresh_mailing_data(mailing, mailing_data):
+    """
+    Пока бот не сообщил file_id всех медиафайлов рассылки, не чаще раза
+    в MAILING_FILE_ID_CHECK_INTERVAL секунд проверяет, не появились ли они,
+    и пересобирает сообщения, чтобы следующие пакеты ссылались на file_id
+    вместо повторной загрузки файлов.
+    """
+    if not mailing_data['awaiting_file_ids']:
+        return mailing_data
+    if time.monotonic() - mailing_data['checked_at'] < MAILING_FILE_ID_CHECK_INTERVAL:
+        return mailing_data
+
+    mailing_data['checked_at'] = time.monotonic()
+    has_new_file_ids = MailingMedia.objects.filter(
+        pk__in=mailing_data['awaiting_file_ids'],
+        telegram_file_id__isnull=False
+    ).exists()
+    if has_new_file_ids:
+        return get_mailing_data(mailing)
+    return mailing_data
+
+class TransientBroadcastError(Exception):
+    """Временная ошибка /broadcast: пакет можно отправить повторно"""
+
+
+def post_batch(broadcast_data, retry_unknown_payload=False, sizer=batch_sizer):
+    payload = broadcast_data['payload']
+    with stage_seconds.time(stage='batch_build'):
+        body = payload.batch_body(
+            broadcast_data['user_ids'],
+            broadcast_data['batch_number'],
+            broadcast_data['total_batches']
+        )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Пакет %s: %s", broadcast_data['batch_number'], body.decode('utf-8'))
+
+    started_at = time.monotonic()
+    with upstream_request('broadcast'):
+        try:
+            response = http_client.post(
+                f'{settings.BROADCAST_URL}/broadcast',
+                # Сессия без повторов после отправки запроса: пакет повторяет send_batch
+                idempotent=False,
+                data=body,
+                headers={
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': broadcast_data['idempotency_key'],
+                }
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            sizer.record(started_at, time.monotonic() - started_at, ok=False)
+            raise TransientBroadcastError(f"Ошибка отправки batch {broadcast_data['batch_number']}: {e}") from e
+        # Размер пакета подстраивается только под нагрузку бота: ответы 4xx о ней не говорят
+        if 200 <= response.status_code < 300 or response.status_code in BROADCAST_TRANSIENT_STATUSES:
+            sizer.record(started_at, time.monotonic() - started_at, ok=200 <= response.status_code < 300)
+        logger.info(
+            "Отправка batch %s/%s, статус: %s",
+            broadcast_data['batch_number'], broadcast_data['total_batches'], response.status_code
+        )
+        if not 200 <= response.status_code < 300 and not (retry_unknown_payload and payload.is_unknown_payload(response)):
+            error = TransientBroadcastError if response.status_code in BROADCAST_TRANSIENT_STATUSES else Exception
+            raise error(f"Ошибка отправки batch {broadcast_data['batch_number']}: {response.status_code} {response.text[:500]}")
+    return response
+
+def send_batch(broadcast_data, sizer=batch_sizer):
+    """
+    Отправляет пакет в бот. После временной ошибки пакет повторяется
+    до MAILING_BROADCAST_RETRIES раз с растущей паузой, после чего
+    выбрасывается TransientBroadcastError. Время ответа и временные ошибки
+    каждой попытки учитываются в sizer.
+    """
+    payload = broadcast_data['payload']
+    retry_unknown_payload = True
+    attempt = 0
+    while True:
+        try:
+            response = post_batch(broadcast_data, retry_unknown_payload, sizer)
+        except TransientBroadcastError as e:
+            attempt += 1
+            if attempt > MAILING_BROADCAST_RETRIES:
+                raise
+            delay = min(MAILING_BROADCAST_RETRY_BACKOFF_MAX, MAILING_BROADCAST_RETRY_BACKOFF * 2 ** (attempt - 1))
+            delay *= random.uniform(0.5, 1.0)
+            logger.warning(
+                "%s; повтор %s/%s через %.1f с",
+                e, attempt, MAILING_BROADCAST_RETRIES, delay
+            )
+            time.sleep(delay)
+            continue
+
+        if 200 <= response.status_code < 300:
+            return response
+        # Бот не знает payload_id (например, потерял регистрации после перезапуска)
+        # и отклонил пакет целиком, поэтому повтор не дублирует сообщения
+        logger.warning(
+            "Бот не знает сообщения рассылки %s (%s), регистрируем заново",
+            payload.broadcast_id, response.status_code
+        )
+        payload.forget()
+        retry_unknown_payload = False
+
+def mark_batch_sent(mailing_id, batch_number, sent_at):
+    """
+    Сохраняет время отправки пакета: по нему процесс, получивший отчет бота,
+    считает задержку отчета (status_callback_lag_seconds).
+    """
+    MailingBatch.objects.bulk_create(
+        [MailingBatch(mailing_id=mailing_id, batch_number=batch_number, sent_at=sent_at)],
+        update_conflicts=True,
+        unique_fields=['mailing', 'batch_number'],
+        update_fields=['sent_at'],
+    )
+
+class DispatchProgress:
+    """
+    Контрольная точка отправки рассылки.
+
+    Пакеты отправляются параллельно и завершаются не по порядку, поэтому
+    сохраняется только непрерывный префикс: номер последнего пакета, до которого
+    включительно все пакеты приняты ботом, количество пользователей в них
+    и позиция в выборке пользователей сразу после этого пакета.
+    После падения обработчика отправка продолжается с этой позиции
+    и со следующего номера пакета.
+    """
+
+    def __init__(self, mailing, owner=WORKER_ID):
+        self.mailing_id = mailing.pk
+        self.owner = owner
+        self.last_batch = mailing.last_dispatched_batch
+        self.offset = mailing.dispatch_offset
+        self.position = mailing.audience_position
+        self._sent = {}
+        self._lock = threading.Lock()
+
+    def mark_sent(self, batch_number, users_count, position):
+        with self._lock:
+            self._sent[batch_number] = (users_count, position)
+            if self.last_batch + 1 not in self._sent:
+                return
+            while self.last_batch + 1 in self._sent:
+                self.last_batch += 1
+                users_count, self.position = self._sent.pop(self.last_batch)
+                self.offset += users_count
+
+            Mailing.objects.filter(
+                pk=self.mailing_id,
+                lease_owner=self.owner,
+                last_dispatched_batch__lt=self.last_batch
+            ).update(
+                last_dispatched_batch=self.last_batch,
+                dispatch_offset=self.offset,
+                audience_position=self.position,
+                batch_size=users_count
+            )
+
+class LeaseHeartbeat:
+    """
+    Фоновый поток, продлевающий аренду рассылки, пока она отправляется.
+    Если аренду продлить не удалось, выставляет событие lost.
+    """
+
+    def __init__(self, mailing, owner=WORKER_ID, lease_seconds=MAILING_LEASE_SECONDS):
+        self.mailing = mailing
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f'mailing-{mailing.pk}-lease', daemon=True
+        )
+
+    def _run(self):
+        try:
+            while not self._stopped.wait(self.lease_seconds / 3):
+                try:
+                    renewed = Mailing.objects.renew_lease(self.mailing.pk, self.owner, self.lease_seconds)
+                except Exception as e:
+                    logger.error("Ошибка продления аренды рассылки %s: %s", self.mailing.pk, e)
+                    continue
+                if not renewed:
+                    logger.warning("Аренда рассылки %s потеряна", self.mailing.pk)
+                    self.lost.set()
+                    return
+        finally:
+            connections.close_all()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+def build_audience_snapshot(mailing, filters):
+    """
+    Строит снимок аудитории рассылки, если его еще нет.
+    Повторный запуск (продолжение после сбоя) использует уже готовый снимок.
+
+    Аудитория - пользователи по фильтрам (через кэш сегментов) или, если задано
+    audience_expression, результат составного выражения над сегментами
+    и получателями прошлых рассылок.
+
+    Returns:
+        AudienceSnapshot: снимок аудитории
+    """
+    snapshot = AudienceSnapshot.for_mailing(mailing.pk, mailing.snapshot_generation)
+    if snapshot.exists():
+        return snapshot
+    delete_stale_generations(mailing.pk, mailing.snapshot_generation)
+
+    started_at = time.monotonic()
+    if mailing.audience_expression:
+        audience_size = AudienceExpression(filters).write(mailing.audience_expression, snapshot)
+        source = 'составная аудитория'
+    else:
+        audience_size, source = resolve_filters(filters, snapshot)
+
+    elapsed = time.monotonic() - started_at
+    stage_seconds.observe(elapsed, stage='snapshot')
+    Mailing.objects.filter(pk=mailing.pk).update(audience_size=audience_size)
+    mailing.audience_size = audience_size
+    logger.info("Снимок аудитории рассылки %s: %s пользователей за %.2f с (%s)", mailing.pk, audience_size, elapsed, source)
+    return snapshot
+
+def dispatch_mailing(mailing, mailing_data, snapshot, should_stop=None, progress=None, sizer=batch_sizer, fair_queue=send_queue):
+    """
+    Отправляет рассылку конвейером: текущий поток читает пользователей из снимка
+    аудитории (AudienceSnapshot) и ставит готовые пакеты в общую очередь отправки
+    fair_queue (FairQueue), где они чередуются с пакетами других рассылок
+    с учетом приоритета и общего лимита скорости. Если бот не успевает,
+    очередь рассылки заполняется и чтение приостанавливается.
+
+    Размер пакетов подбирает sizer (AdaptiveBatchSize) по времени ответа
+    /broadcast. Номера пакетов идут подряд; total_batches до последнего
+    пакета - оценка по текущему размеру, в последнем пакете он равен его номеру.
+
+    should_stop вызывается перед каждым блоком снимка: если он вернул True,
+    чтение прекращается, а уже поставленные в очередь пакеты досылаются.
+
+    Если передан progress (DispatchProgress), отправка продолжается с позиции
+    в снимке и номера пакета из сохраненной контрольной точки, и каждый
+    принятый ботом пакет отмечается в ней.
+
+    Returns:
+        Tuple[int, bool]: количество пользователей, переданных в бот
+        (включая отправленных до контрольной точки), и признак того,
+        что аудитория пройдена полностью
+    """
+    def send(broadcast_data):
+        # Бот может прислать отчет раньше, чем вернется ответ на /broadcast
+        sent_at = timezone.now()
+        send_batch(broadcast_data, sizer)
+        mark_batch_sent(mailing.pk, broadcast_data['batch_number'], sent_at)
+        append_sent_ids(mailing.pk, broadcast_data['user_ids'], mailing.snapshot_generation)
+        batches_sent.inc()
+        users_sent.inc(len(broadcast_data['user_ids']))
+        if progress is not None:
+            progress.mark_sent(
+                broadcast_data['batch_number'],
+                len(broadcast_data['user_ids']),
+                broadcast_data['position']
+            )
+
+    flow = fair_queue.open_flow(f'mailing-{mailing.pk}', mailing.priority, send)
+    failed = flow.failed
+
+    position = 0
+    batch_number = 0
+    total_users = 0
+    if progress is not None:
+        position = progress.position
+        batch_number = progress.last_batch
+        total_users = progress.offset
+
+    # Срочные рассылки отправляются без ограничения частоты, но учитываются в нем
+    frequency_capped = delivery_index.enabled and mailing.priority < Mailing.Priority.URGENT
+
+    # Пользователи, еще не попавшие в пакет: (позиция в снимке после пользователя, id)
+    pending = []
+    completed = False
+
+    def put_batch(size, last):
+        nonlocal batch_number, total_users, mailing_data
+        chunk = pending[:size]
+        del pending[:size]
+        batch_number += 1
+        end_position = chunk[-1][0]
+        if last:
+            total_batches = batch_number
+            Mailing.objects.filter(pk=mailing.pk).update(total_batches=total_batches)
+        else:
+            remaining = max(1, total_count - end_position)
+            total_batches = batch_number + (remaining + sizer.size - 1) // sizer.size
+
+        # Бот получает id строками, как их отдает /users/filter
+        users = [str(user_id) for _, user_id in chunk]
+        total_users += len(users)
+        if delivery_index.enabled:
+            save_batch_ids(mailing.pk, batch_number, users)
+        mailing_data = refresh_mailing_data(mailing, mailing_data)
+        # Лимит бота считается в сообщениях: каждому пользователю уходят все сообщения рассылки
+        fair_queue.put(flow, {
+            'payload': mailing_data['payload'],
+            'user_ids': users,
+            'batch_number': batch_number,
+            'total_batches': total_batches,
+            'position': end_position,
+            # Один ключ на пакет: повторы того же пакета бот отбрасывает
+            'idempotency_key': uuid.uuid4().hex,
+        }, cost=len(users) * max(1, len(mailing_data['messages'])))
+
+    try:
+        total_count = len(snapshot)
+        estimated = batch_number + (max(0, total_count - position) + sizer.size - 1) // sizer.size
+        Mailing.objects.filter(pk=mailing.pk).update(total_batches=estimated)
+        if batch_number:
+            logger.info("Продолжение рассылки %s с пакета %s (позиция %s/%s)", mailing.pk, batch_number + 1, position, total_count)
+
+        for block_start, users in snapshot.iter_blocks(start=position):
+            if failed.is_set():
+                break
+            if should_stop is not None and should_stop():
+                break
+
+            entries = [(block_start + i + 1, user_id) for i, user_id in enumerate(users)]
+
+            if frequency_capped:
+                delivery_index.refresh()
+                kept = [entry for entry in entries if entry[1] not in delivery_index]
+                capped = len(entries) - len(kept)
+                if capped:
+                    users_skipped.inc(capped, reason='frequency_cap')
+                    logger.info(
+                        "Исключено %s пользователей, уже получивших %s рассылок за окно (позиции %s-%s)",
+                        capped, delivery_index.cap, block_start, block_start + len(users)
+                    )
+                entries = kept
+
+            if MAILING_SUPPRESSION_ENABLED and len(suppression_list):
+                kept = [entry for entry in entries if entry[1] not in suppression_list]
+                suppressed = len(entries) - len(kept)
+                if suppressed:
+                    users_skipped.inc(suppressed, reason='suppressed')
+                    logger.info(
+                        "Исключено %s пользователей с постоянными ошибками доставки (позиции %s-%s)",
+                        suppressed, block_start, block_start + len(users)
+                    )
+                entries = kept
+
+            pending.extend(entries)
+
+            # Пакет отправляется, только когда за ним есть еще пользователи:
+            # так последний пакет известен заранее и получает точный total_batches
+            while len(pending) > sizer.size and not failed.is_set():
+                put_batch(sizer.size, last=False)
+        else:
+            completed = True
+
+        if completed:
+            while pending and not failed.is_set():
+                size = sizer.size
+                put_batch(size, last=len(pending) <= size)
+    finally:
+        fair_queue.join(flow)
+
+    if flow.errors:
+        raise flow.errors[0]
+    return total_users, completed
+
+def process_mailing(mailing, stop_event=None):
+    logger.info("Обработка рассылки: %s (ID: %s), запланировано на %s", mailing.title, mailing.id, mailing.scheduled_at)
+
+    filters = mailing.group_filters or {}
+
+    with LeaseHeartbeat(mailing) as heartbeat:
+        def should_stop():
+            return heartbeat.lost.is_set() or (stop_event is not None and stop_event.is_set())
+
+        try:
+            if MAILING_SUPPRESSION_ENABLED:
+                suppression_list.refresh()
+            delivery_index.refresh(force=True)
+            snapshot = build_audience_snapshot(mailing, filters)
+            mailing_data = get_mailing_data(mailing)
+            total_users, completed = dispatch_mailing(
+                mailing, mailing_data, snapshot,
+                should_stop=should_stop,
+                progress=DispatchProgress(mailing)
+            )
+        except (TransientBroadcastError, requests.ConnectionError, requests.Timeout) as e:
+            # Сбой на стороне бота или сервиса пользователей: рассылка остается
+            # в обработке с контрольной точкой и будет продолжена позже
+            retry_at = timezone.now() + timedelta(seconds=MAILING_TRANSIENT_RETRY_DELAY)
+            logger.warning(
+                "Рассылка %s приостановлена до %s из-за временной ошибки: %s",
+                mailing.pk, retry_at, e
+            )
+            Mailing.objects.abandon(mailing.pk, WORKER_ID, retry_at=retry_at, error_message=str(e))
+            scheduler.schedule(mailing.pk, retry_at)
+            return
+        except Exception as e:
+            Mailing.objects.release(mailing.pk, WORKER_ID, Mailing.Status.FAILED, error_message=str(e))
+            raise
+
+    if heartbeat.lost.is_set():
+        logger.warning("Рассылка %s прервана: аренда перешла другому обработчику", mailing.pk)
+        return
+
+    if not completed:
+        # Остановка обработчика: отдаем рассылку другим обработчикам
+        logger.info("Рассылка %s прервана остановкой обработчика", mailing.pk)
+        Mailing.objects.abandon(mailing.pk, WORKER_ID)
+        return
+
+    logger.info("Рассылка %s: всего передано пользователей: %s", mailing.pk, total_users)
+
+    if total_users > 0:
+        # Сбрасываем ошибку, если отправка прерывалась временной ошибкой
+        Mailing.objects.release(mailing.pk, WORKER_ID, Mailing.Status.COMPLETED, error_message=None)
+    else:
+        # Все пользователи отфильтрованы (пустой сегмент, список подавления,
+        # ограничение частоты): отправлять нечего, рассылка завершена
+        logger.warning("Рассылка %s: нет пользователей для отправки", mailing.pk)
+        Mailing.objects.release(
+            mailing.pk, WORKER_ID, Mailing.Status.COMPLETED,
+            error_message='Нет пользователей для отправки'
+        )
+
+def process_pending_mailings(stop_event=None):
+    """
+    Забирает и отправляет рассылки по одной, пока есть готовые к отправке.
+
+    Returns:
+        int: количество обработанных рассылок
+    """
+    processed = 0
+    while stop_event is None or not stop_event.is_set():
+        with stage_seconds.time(stage='claim'):
+            claimed = Mailing.objects.claim(WORKER_ID, MAILING_LEASE_SECONDS)
+        if not claimed:
+            break
+        # Даем другим потокам обработчика проверить, нет ли еще готовых рассылок
+        scheduler.wake()
+        processed += 1
+        try:
+            process_mailing(claimed[0], stop_event=stop_event)
+        except Exception as e:
+            # Рассылка уже переведена в FAILED; остальные готовые рассылки отправляем дальше
+            logger.exception("Ошибка отправки рассылки %s: %s", claimed[0].pk, e)
+    return processed
+
+
+class Dispatcher:
+    """
+    Обработчик рассылок: workers потоков параллельно забирают готовые рассылки
+    и отправляют их. Каждый поток спит до ближайшего scheduled_at.
+
+    stop() прекращает загрузку новых страниц, дожидается отправки уже
+    сформированных пакетов и возвращает незавершенные рассылки в общий пул.
+    """
+
+    def __init__(self, workers=MAILING_DISPATCHER_WORKERS):
+        self.workers = max(1, workers)
+        self.stop_event = threading.Event()
+        self.listener = ScheduleListener(scheduler)
+        self._threads = []
+
+    def _run_worker(self):
+        while not self.stop_event.is_set():
+            try:
+                if getattr(settings, 'ENABLE_MAILING_CHECK', False):
+                    # Спим до ближайшего scheduled_at (или до сигнала об изменении рассылки)
+                    scheduler.wait_due(timeout=MAILING_DISPATCHER_POLL_TIMEOUT)
+                    if self.stop_event.is_set():
+                        break
+                    processed = process_pending_mailings(stop_event=self.stop_event)
+                    if processed:
+                        logger.info("Обработано %s рассылок", processed)
+                else:
+                    logger.info("Отслеживание рассылок отключено")
+                    self.stop_event.wait(60)
+
+            except Exception as e:
+                # Сбой базы или планировщика: короткая пауза, чтобы не зациклиться на ошибке
+                logger.exception("Ошибка обработчика рассылок: %s", e)
+                self.stop_event.wait(1)
+            finally:
+                close_old_connections()
+
+    def start(self):
+        # Изменения рассылок из других процессов (админка в веб-процессе)
+        self.listener.start()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run_worker, name=f'mailing-dispatcher-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        self.listener.stop()
+        scheduler.wake()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run(self):
+        self.start()
+        try:
+            # join с таймаутом, чтобы главный поток мог обрабатывать сигналы
+            while any(thread.is_alive() for thread in self._threads):
+                self.join(timeout=1)
+        finally:
+            self.stop()
+            self.join()
+
+
+def check_mailings_daemon():
+    Dispatcher(workers=MAILING_DISPATCHER_WORKERS).run()
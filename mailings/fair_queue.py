@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+# Общий лимит отправки: сколько сообщений в секунду передавать в бот
+# (пакет из N пользователей рассылки из M сообщений - это N * M сообщений).
+# Запас токенов хранится в базе (MailingSendBudget), поэтому лимит общий
+# для всех процессов и хостов с обработчиками, а не для каждого из них.
+# Должен соответствовать тому, сколько сообщений бот успевает отправить
+# (Telegram допускает около 30 сообщений в секунду на бота); 0 - без лимита
+MAILING_SEND_RATE = getattr(settings, 'MAILING_SEND_RATE', 30)
+# Сколько сообщений можно передать разом после простоя
+MAILING_SEND_BURST = getattr(settings, 'MAILING_SEND_BURST', 1000)
+
+# Количество потоков, отправляющих пакеты всех рассылок в бот
+MAILING_SENDER_THREADS = getattr(settings, 'MAILING_SENDER_THREADS', 2)
+# Сколько готовых пакетов одной рассылки может ждать отправки
+# (backpressure для загрузки страниц)
+MAILING_QUEUE_SIZE = getattr(settings, 'MAILING_QUEUE_SIZE', 4)
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости: rate токенов в секунду, не больше capacity в запасе.
+
+    Пакет может быть больше capacity: тогда acquire дожидается полного запаса
+    и уходит в долг, который отрабатывается следующими запросами.
+    """
+
+    def __init__(self, rate=MAILING_SEND_RATE, capacity=MAILING_SEND_BURST):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, tokens):
+        if not self.rate:
+            return
+        needed = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket, запас которого хранится в строке MailingSendBudget
+    и общий для всех процессов-обработчиков. Строка блокируется
+    (SELECT ... FOR UPDATE) только на время пересчета запаса.
+
+    Время пополнения берется по часам процесса, поэтому часы хостов
+    должны быть синхронизированы; расхождение ограничено запасом capacity.
+    """
+
+    def __init__(self, rate=MAILING_SEND_RATE, capacity=MAILING_SEND_BURST, key='broadcast'):
+        super().__init__(rate, capacity)
+        self.key = key
+
+    def acquire(self, tokens):
+        from mailings.models import MailingSendBudget
+
+        if not self.rate:
+            return
+        needed = min(tokens, self.capacity)
+        while True:
+            with transaction.atomic():
+                budget = MailingSendBudget.objects.select_for_update().filter(key=self.key).first()
+                now = timezone.now()
+                if budget is None:
+                    MailingSendBudget.objects.bulk_create(
+                        [MailingSendBudget(key=self.key, tokens=self.capacity, updated_at=now)],
+                        ignore_conflicts=True
+                    )
+                    continue
+                elapsed = max(0.0, (now - budget.updated_at).total_seconds())
+                available = min(self.capacity, budget.tokens + elapsed * self.rate)
+                if available >= needed:
+                    budget.tokens = available - tokens
+                    budget.updated_at = now
+                    budget.save(update_fields=['tokens', 'updated_at'])
+                    return
+                wait = (needed - available) / self.rate
+            time.sleep(wait)
+
+
+class Flow:
+    """
+    Поток пакетов одной рассылки в FairQueue.
+
+    handler вызывается потоком отправки для каждого пакета. Если он упал,
+    поток помечается failed, а остальные пакеты рассылки пропускаются.
+    """
+
+    def __init__(self, name, weight, handler, maxsize):
+        self.name = name
+        self.weight = max(1, weight)
+        self.handler = handler
+        self.maxsize = maxsize
+        self.last_finish = 0.0
+        self.queued = 0
+        self.unfinished = 0
+        self.errors = []
+        self.failed = threading.Event()
+
+
+class FairQueue:
+    """
+    Общая очередь отправки пакетов всех рассылок процесса.
+
+    Пакеты разных рассылок чередуются по алгоритму взвешенной справедливой
+    очереди (self-clocked fair queuing): каждому пакету назначается виртуальное
+    время завершения start + cost / weight, где cost - количество сообщений в пакете,
+    а weight - приоритет рассылки, и первым отправляется пакет с наименьшим.
+    Поэтому небольшая или срочная рассылка завершается быстро, даже если
+    одновременно идет большая, а большая продолжает отправляться в своей доле.
+
+    Перед отправкой пакета из общего TokenBucket забирается cost токенов.
+    """
+
+    def __init__(self, bucket=None, senders=MAILING_SENDER_THREADS, flow_queue_size=MAILING_QUEUE_SIZE):
+        self.bucket = bucket or TokenBucket()
+        self.senders = max(1, senders)
+        self.flow_queue_size = max(1, flow_queue_size)
+        self._heap = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def open_flow(self, name, weight, handler):
+        return Flow(name, weight, handler, self.flow_queue_size)
+
+    def put(self, flow, item, cost):
+        """
+        Ставит пакет в очередь. Блокируется, пока у рассылки уже
+        flow_queue_size пакетов ждут отправки.
+        """
+        with self._condition:
+            self._ensure_started()
+            while flow.queued >= flow.maxsize and not flow.failed.is_set():
+                self._condition.wait()
+            start = max(self._virtual_time, flow.last_finish)
+            flow.last_finish = start + max(1, cost) / flow.weight
+            flow.queued += 1
+            flow.unfinished += 1
+            heapq.heappush(self._heap, (flow.last_finish, next(self._seq), flow, item, cost))
+            self._condition.notify_all()
+
+    def join(self, flow):
+        """
+        Ждет, пока все пакеты рассылки будут отправлены или пропущены.
+        """
+        with self._condition:
+            while flow.unfinished:
+                self._condition.wait()
+
+    def _ensure_started(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        for i in range(len(self._threads), self.senders):
+            thread = threading.Thread(target=self._run_sender, name=f'mailing-sender-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _take(self):
+        with self._condition:
+            while not self._heap:
+                self._condition.wait()
+            finish, _, flow, item, cost = heapq.heappop(self._heap)
+            self._virtual_time = finish
+            flow.queued -= 1
+            self._condition.notify_all()
+            return flow, item, cost
+
+    def _done(self, flow):
+        with self._condition:
+            flow.unfinished -= 1
+            self._condition.notify_all()
+
+    def _run_sender(self):
+        while True:
+            flow, item, cost = self._take()
+            try:
+                if not flow.failed.is_set():
+                    self.bucket.acquire(cost)
+                    flow.handler(item)
+            except Exception as e:
+                flow.errors.append(e)
+                flow.failed.set()
+            finally:
+                self._done(flow)
+                close_old_connections()
+
+
+send_queue = FairQueue(bucket=SharedTokenBucket())
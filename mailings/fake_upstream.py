@@ -0,0 +1,190 @@
+import json
+import math
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+from urllib.parse import parse_qs, urlsplit
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело уходят отдельными записями: без TCP_NODELAY
+    # клиент ждет отложенного ACK и к каждому ответу добавляется ~40 мс
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _reply(self, status: int, data: Any = None) -> None:
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self._read_body()
+        if url.path == '/auth/login':
+            self._reply(201, {'accessToken': 'bench-token'})
+        elif url.path == '/users/filter':
+            query = parse_qs(url.query)
+            self.server.users_filter(self, int(query['page'][0]), int(query['limit'][0]))
+        elif url.path == '/broadcast':
+            self.server.broadcast(self, body)
+        else:
+            self._reply(404, {'message': 'Not found'})
+
+    def do_PUT(self):
+        self._read_body()
+        if self.path.startswith('/payloads/') and self.server.config['payloads']:
+            self._reply(204)
+        else:
+            self._reply(404, {'message': 'Not found'})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: Dict[str, Any]):
+        super().__init__(address, _Handler)
+        self.config = config
+        audience = config['audience']
+        # Шаг перестановки: /users/filter отдает id 1..audience не по порядку
+        self._step = max(1, int(audience * 0.618)) | 1
+        while math.gcd(self._step, audience or 1) != 1:
+            self._step += 2
+        # Полученные пользователи по рассылкам (broadcast_id)
+        self._seen: Dict[str, bytearray] = {}
+        # Принятые пакеты по Idempotency-Key: повтор пакета не рассылается
+        self._batch_keys = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'users_filter_requests': 0,
+            'broadcast_requests': 0,
+            'injected_errors': 0,
+            'users_received': 0,
+            'duplicate_users': 0,
+            'repeated_batches': 0,
+        }
+
+    def _delay_or_fail(self, handler: _Handler, latency: float) -> bool:
+        if latency:
+            time.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < self.config['error_rate']:
+            with self._lock:
+                self._stats['injected_errors'] += 1
+            handler._reply(503, {'message': 'Injected error'})
+            return True
+        return False
+
+    def users_filter(self, handler: _Handler, page: int, limit: int) -> None:
+        with self._lock:
+            self._stats['users_filter_requests'] += 1
+        if self._delay_or_fail(handler, self.config['users_latency']):
+            return
+        audience = self.config['audience']
+        start = min(audience, (page - 1) * limit)
+        stop = min(audience, start + limit)
+        users = [str(index * self._step % audience + 1) for index in range(start, stop)]
+        handler._reply(201, {'count': audience, 'users': users})
+
+    def broadcast(self, handler: _Handler, body: bytes) -> None:
+        with self._lock:
+            self._stats['broadcast_requests'] += 1
+        if self._delay_or_fail(handler, self.config['broadcast_latency']):
+            return
+        data = json.loads(body)
+        user_ids = data.get('user_ids', [])
+        key = handler.headers.get('Idempotency-Key')
+        with self._lock:
+            if key is not None and key in self._batch_keys:
+                self._stats['repeated_batches'] += 1
+                handler._reply(200, {'status': 'duplicate'})
+                return
+            self._batch_keys.add(key)
+            seen = self._seen.get(data.get('broadcast_id'))
+            if seen is None:
+                seen = self._seen[data.get('broadcast_id')] = bytearray(self.config['audience'] + 1)
+            for user_id in user_ids:
+                user_id = int(user_id)
+                if seen[user_id]:
+                    self._stats['duplicate_users'] += 1
+                seen[user_id] = 1
+            self._stats['users_received'] += len(user_ids)
+        handler._reply(200, {'status': 'accepted'})
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, unique_users=sum(sum(seen) for seen in self._seen.values()))
+
+
+def _serve(config: Dict[str, Any], conn) -> None:
+    server = _Server(('127.0.0.1', 0), config)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    conn.send(server.server_address[1])
+    conn.recv()
+    server.shutdown()
+    conn.send(server.stats())
+
+
+class FakeUpstream:
+    """
+    Локальные заглушки сервиса пользователей (/auth/login, /users/filter)
+    и бота (PUT /payloads/{id}, /broadcast) для нагрузочных тестов.
+
+    Сервер работает в отдельном процессе, чтобы его нагрузка не влияла
+    на замеры обработчика. Ответы /users/filter и /broadcast задерживаются
+    на latency ±50% секунд, доля error_rate запросов получает 503.
+    Бот учитывает полученных пользователей и повторы внутри каждой рассылки;
+    повтор пакета с тем же Idempotency-Key принимается без рассылки.
+    """
+
+    def __init__(
+        self,
+        audience: int,
+        users_latency: float = 0.05,
+        broadcast_latency: float = 0.1,
+        error_rate: float = 0.0,
+        payloads: bool = True
+    ):
+        self.config = {
+            'audience': audience,
+            'users_latency': users_latency,
+            'broadcast_latency': broadcast_latency,
+            'error_rate': error_rate,
+            'payloads': payloads,
+        }
+        self._process = None
+        self._conn = None
+
+    def start(self) -> str:
+        """
+        Returns:
+            str: базовый URL заглушек
+        """
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(self.config, child_conn), daemon=True)
+        self._process.start()
+        port = self._conn.recv()
+        return f'http://127.0.0.1:{port}'
+
+    def stop(self) -> Dict[str, int]:
+        """
+        Останавливает сервер.
+
+        Returns:
+            Dict[str, int]: статистика запросов и полученных пользователей
+        """
+        self._conn.send('stop')
+        stats = self._conn.recv()
+        self._process.join()
+        return stats
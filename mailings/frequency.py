@@ -0,0 +1,395 @@
+import bisect
+import fcntl
+import heapq
+import logging
+import os
+import threading
+import time
+from array import array
+from datetime import timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .id_store import data_path, to_int_ids
+
+logger = logging.getLogger(__name__)
+
+# Сколько рассылок пользователь может получить за окно; 0 - без ограничения (по умолчанию)
+MAILING_FREQUENCY_CAP = getattr(settings, 'MAILING_FREQUENCY_CAP', 0)
+# Окно ограничения (секунды)
+MAILING_FREQUENCY_WINDOW = getattr(settings, 'MAILING_FREQUENCY_WINDOW', 24 * 3600)
+# Размер временной корзины доставок (секунды)
+MAILING_FREQUENCY_BUCKET = getattr(settings, 'MAILING_FREQUENCY_BUCKET', 3600)
+# Как часто обработчик перечитывает доставки во время отправки (секунды)
+MAILING_FREQUENCY_REFRESH_INTERVAL = getattr(settings, 'MAILING_FREQUENCY_REFRESH_INTERVAL', 60)
+
+# Сколько пакетов с отчетами учитывается за одну транзакцию
+_REPORTED_BATCHES_CHUNK = 500
+
+# Через сколько секунд после закрытия корзины в нее уже не пишут и ее можно сжать
+_BUCKET_GRACE = 60
+
+
+def save_batch_ids(mailing_id: int, batch_number: int, user_ids: List[Any]) -> None:
+    """
+    Сохраняет состав пакета в MailingBatch.user_ids: отчет бота содержит только
+    количество доставленных, а для учета доставок нужны сами пользователи.
+    Состав хранится в базе, а не в MAILING_DATA_DIR: отчет приходит
+    в веб-процесс, который может работать на другом хосте.
+    """
+    from .models import MailingBatch
+
+    MailingBatch.objects.bulk_create(
+        [MailingBatch(mailing_id=mailing_id, batch_number=batch_number, user_ids=to_int_ids(user_ids).tobytes())],
+        update_conflicts=True,
+        unique_fields=['mailing', 'batch_number'],
+        update_fields=['user_ids'],
+    )
+
+
+def clear_stale_batch_ids(max_age: float) -> int:
+    """
+    Стирает состав пакетов, отчет о которых не пришел за max_age секунд:
+    такие доставки уже не попадут в окно ограничения.
+
+    Returns:
+        int: количество пакетов
+    """
+    from .models import MailingBatch
+
+    return MailingBatch.objects.filter(
+        user_ids__isnull=False,
+        reported_at__isnull=True,
+        created_at__lt=timezone.now() - timedelta(seconds=max_age)
+    ).update(user_ids=None)
+
+
+def _read_complete_ids(path: str) -> array:
+    """
+    Читает журнал корзины; неполная запись в конце (идет дозапись) отбрасывается.
+    """
+    ids = array('q')
+    with open(path, 'rb') as f:
+        data = f.read()
+    ids.frombytes(data[:len(data) // ids.itemsize * ids.itemsize])
+    return ids
+
+
+def _count_sorted(ids: Iterable[int]) -> Tuple[array, array]:
+    """
+    Счетчики по возрастающей последовательности id: (id, количество повторов).
+    """
+    user_ids, counts = array('q'), array('I')
+    for user_id in ids:
+        if user_ids and user_ids[-1] == user_id:
+            counts[-1] += 1
+        else:
+            user_ids.append(user_id)
+            counts.append(1)
+    return user_ids, counts
+
+
+def _merge_counts(sources: List[Tuple[array, array]]) -> Iterator[Tuple[int, int]]:
+    """
+    Сливает отсортированные счетчики нескольких корзин, суммируя их по пользователю.
+    """
+    previous, total = None, 0
+    for user_id, count in heapq.merge(*(zip(ids, counts) for ids, counts in sources)):
+        if user_id == previous:
+            total += count
+            continue
+        if previous is not None:
+            yield previous, total
+        previous, total = user_id, count
+    if previous is not None:
+        yield previous, total
+
+
+def _write_counts(path: str, user_ids: array, counts: array) -> None:
+    """
+    Файл счетчиков корзины: n id (int64), затем n счетчиков (uint32).
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        user_ids.tofile(f)
+        counts.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def _read_counts(path: str) -> Tuple[array, array]:
+    user_ids, counts = array('q'), array('I')
+    with open(path, 'rb') as f:
+        data = f.read()
+    size = len(data) // (user_ids.itemsize + counts.itemsize)
+    user_ids.frombytes(data[:size * user_ids.itemsize])
+    counts.frombytes(data[size * user_ids.itemsize:])
+    return user_ids, counts
+
+
+class DeliveryIndex:
+    """
+    Недавние доставки рассылок по пользователям для ограничения частоты.
+
+    Доставки группируются во временные корзины по MAILING_FREQUENCY_BUCKET
+    секунд. В открытую корзину доставки пишутся журналом (id int64 дозаписью
+    в конец файла, это безопасно из нескольких процессов); после закрытия
+    корзина сжимается в счетчики - отсортированные id и количество доставок
+    каждому пользователю за корзину.
+
+    refresh() суммирует счетчики закрытых корзин окна только когда меняется
+    их набор (раз в корзину), а при остальных обновлениях досчитывает лишь
+    открытые корзины с поиском по суммам. В памяти остаются суммы по закрытым
+    корзинам и множество пользователей, достигших ограничения, поэтому
+    проверка пакета - O(размер пакета).
+
+    Доставки записывает и читает только обработчик (check_mailings): отчеты,
+    пришедшие в веб-процесс, он забирает из базы (record_reported_batches).
+    Если обработчики работают на нескольких хостах, ограничение общее для них
+    только при общем MAILING_DATA_DIR.
+    """
+
+    def __init__(
+        self,
+        cap=MAILING_FREQUENCY_CAP,
+        window=MAILING_FREQUENCY_WINDOW,
+        bucket=MAILING_FREQUENCY_BUCKET,
+        refresh_interval=MAILING_FREQUENCY_REFRESH_INTERVAL,
+        directory=None
+    ):
+        self.cap = cap
+        self.window = window
+        self.bucket = bucket
+        self.refresh_interval = refresh_interval
+        self.directory = directory
+        self._capped: Set[int] = set()
+        self._refreshed_at = None
+        # Суммы по закрытым корзинам окна и набор корзин, по которому они посчитаны
+        self._closed_key = None
+        self._closed_ids = array('q')
+        self._closed_counts = array('I')
+        self._closed_capped: Set[int] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.cap)
+
+    def _directory(self) -> str:
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            return self.directory
+        return os.path.dirname(data_path('deliveries', '_'))
+
+    def record(self, user_ids: array, at: float = None) -> None:
+        """
+        Учитывает доставку рассылки пользователям.
+        """
+        if not user_ids:
+            return
+        bucket_start = int((at or time.time()) // self.bucket * self.bucket)
+        path = os.path.join(self._directory(), f'{bucket_start}.bin')
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, user_ids.tobytes())
+        finally:
+            os.close(fd)
+
+    def record_reported_batches(self) -> int:
+        """
+        Учитывает доставки по пакетам, о которых бот уже отчитался: состав
+        пакета (save_batch_ids) без пользователей с ошибками доставки.
+        Учтенный состав стирается, поэтому пакет учитывается один раз,
+        по первому отчету, и только одним из обработчиков.
+
+        Returns:
+            int: количество учтенных доставок
+        """
+        from .models import MailingBatch, MailingFailure
+
+        recorded = 0
+        while True:
+            with transaction.atomic():
+                batches = list(
+                    MailingBatch.objects.select_for_update(skip_locked=True).filter(
+                        reported_at__isnull=False,
+                        user_ids__isnull=False
+                    ).values_list('pk', 'mailing_id', 'batch_number', 'successful_users', 'user_ids')
+                    [:_REPORTED_BATCHES_CHUNK]
+                )
+                if not batches:
+                    return recorded
+
+                reported = Q()
+                for _, mailing_id, batch_number, successful, _ in batches:
+                    if successful:
+                        reported |= Q(mailing_id=mailing_id, batch_number=batch_number)
+                failed_ids: Dict[Tuple[int, int], Set[int]] = {}
+                if reported:
+                    failures = MailingFailure.objects.filter(reported).values_list(
+                        'mailing_id', 'batch_number', 'user_id'
+                    )
+                    for mailing_id, batch_number, user_id in failures:
+                        failed_ids.setdefault((mailing_id, batch_number), set()).add(user_id)
+
+                for _, mailing_id, batch_number, successful, data in batches:
+                    if not successful:
+                        continue
+                    batch_ids = array('q')
+                    batch_ids.frombytes(data)
+                    failed = failed_ids.get((mailing_id, batch_number))
+                    if failed:
+                        batch_ids = array('q', (user_id for user_id in batch_ids if user_id not in failed))
+                    self.record(batch_ids)
+                    recorded += len(batch_ids)
+
+                MailingBatch.objects.filter(pk__in=[batch[0] for batch in batches]).update(user_ids=None)
+            if len(batches) < _REPORTED_BATCHES_CHUNK:
+                return recorded
+
+    def _compact(self, directory: str, stem: str) -> None:
+        """
+        Сжимает журнал закрытой корзины в счетчики {stem}.counts.bin.
+        """
+        raw_path = os.path.join(directory, f'{stem}.bin')
+        counts_path = os.path.join(directory, f'{stem}.counts.bin')
+        with open(os.path.join(directory, '.compact.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(raw_path):
+                return
+            sources = [_count_sorted(sorted(_read_complete_ids(raw_path)))]
+            if os.path.exists(counts_path):
+                sources.append(_read_counts(counts_path))
+            user_ids, counts = array('q'), array('I')
+            for user_id, count in _merge_counts(sources):
+                user_ids.append(user_id)
+                counts.append(count)
+            _write_counts(counts_path, user_ids, counts)
+            os.remove(raw_path)
+
+    def _scan(self, now: float) -> Tuple[Dict[str, float], List[str], List[str]]:
+        """
+        Сжимает закрытые корзины окна.
+
+        Returns:
+            Tuple: файлы счетчиков закрытых корзин окна (со временем изменения),
+            журналы открытых корзин и файлы корзин вне окна
+        """
+        directory = self._directory()
+        oldest = now - self.window
+        stems = sorted({name.split('.')[0] for name in os.listdir(directory) if name.split('.')[0].isdigit()})
+
+        closed, open_logs, expired = {}, [], []
+        for stem in stems:
+            bucket_start = int(stem)
+            raw_path = os.path.join(directory, f'{stem}.bin')
+            counts_path = os.path.join(directory, f'{stem}.counts.bin')
+            if bucket_start + self.bucket <= oldest:
+                expired.extend(path for path in (raw_path, counts_path) if os.path.exists(path))
+            elif bucket_start + self.bucket + _BUCKET_GRACE < now:
+                self._compact(directory, stem)
+                try:
+                    closed[counts_path] = os.path.getmtime(counts_path)
+                except FileNotFoundError:
+                    continue
+            elif os.path.exists(raw_path):
+                open_logs.append(raw_path)
+        return closed, open_logs, expired
+
+    def _sum_closed(self, closed: Dict[str, float]) -> None:
+        """
+        Пересчитывает суммы по закрытым корзинам окна. Обычно набор меняется
+        на одну корзину с каждой стороны: суммы сдвигаются - прибавляется
+        новая корзина и вычитается вышедшая из окна. Если прежние корзины
+        изменились или уже удалены, суммы считаются заново.
+        """
+        previous = self._closed_key[1] if self._closed_key and self._closed_key[0] == self.cap else None
+        sources = []
+        try:
+            if previous is None or any(path in closed and closed[path] != mtime for path, mtime in previous):
+                raise FileNotFoundError
+            previous_paths = dict(previous)
+            sources.append((self._closed_ids, self._closed_counts))
+            for path in closed:
+                if path not in previous_paths:
+                    sources.append(_read_counts(path))
+            for path in previous_paths:
+                if path not in closed:
+                    user_ids, counts = _read_counts(path)
+                    sources.append((user_ids, (-count for count in counts)))
+        except FileNotFoundError:
+            sources = []
+            for path in closed:
+                try:
+                    sources.append(_read_counts(path))
+                except FileNotFoundError:
+                    continue
+
+        user_ids, counts, capped = array('q'), array('I'), set()
+        for user_id, count in _merge_counts(sources):
+            if count <= 0:
+                continue
+            user_ids.append(user_id)
+            counts.append(count)
+            if count >= self.cap:
+                capped.add(user_id)
+        self._closed_ids, self._closed_counts, self._closed_capped = user_ids, counts, capped
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        Перечитывает доставки за окно, если с прошлого раза прошло
+        refresh_interval секунд (или force).
+
+        Returns:
+            int: количество пользователей, достигших ограничения
+        """
+        if not self.enabled:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._refreshed_at is not None and now - self._refreshed_at < self.refresh_interval:
+                return len(self._capped)
+
+            self.record_reported_batches()
+            clear_stale_batch_ids(self.window)
+
+            closed, open_logs, expired = self._scan(time.time())
+            key = (self.cap, tuple(sorted(closed.items())))
+            if key != self._closed_key:
+                self._sum_closed(closed)
+                self._closed_key = key
+            # Вышедшие из окна корзины удаляются после того, как вычтены из сумм
+            for path in expired:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+            recent = array('q')
+            for path in open_logs:
+                try:
+                    recent.extend(_read_complete_ids(path))
+                except FileNotFoundError:
+                    continue
+
+            capped = set(self._closed_capped)
+            closed_ids, closed_counts = self._closed_ids, self._closed_counts
+            for user_id, count in zip(*_count_sorted(sorted(recent))):
+                index = bisect.bisect_left(closed_ids, user_id)
+                if index < len(closed_ids) and closed_ids[index] == user_id:
+                    count += closed_counts[index]
+                if count >= self.cap:
+                    capped.add(user_id)
+
+            self._capped = capped
+            self._refreshed_at = now
+            return len(capped)
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._capped
+
+
+delivery_index = DeliveryIndex()
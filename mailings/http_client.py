@@ -0,0 +1,107 @@
+import threading
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+# Размеры пулов соединений
+HTTP_POOL_CONNECTIONS = getattr(settings, 'HTTP_POOL_CONNECTIONS', 4)
+HTTP_POOL_MAXSIZE = getattr(settings, 'HTTP_POOL_MAXSIZE', 20)
+
+# Таймауты (секунды)
+HTTP_CONNECT_TIMEOUT = getattr(settings, 'HTTP_CONNECT_TIMEOUT', 5)
+HTTP_READ_TIMEOUT = getattr(settings, 'HTTP_READ_TIMEOUT', 30)
+
+# Повторы при ошибках соединения и 5xx
+HTTP_RETRY_TOTAL = getattr(settings, 'HTTP_RETRY_TOTAL', 3)
+HTTP_RETRY_BACKOFF = getattr(settings, 'HTTP_RETRY_BACKOFF', 0.5)
+HTTP_RETRY_BACKOFF_MAX = getattr(settings, 'HTTP_RETRY_BACKOFF_MAX', 10)
+HTTP_RETRY_JITTER = getattr(settings, 'HTTP_RETRY_JITTER', 0.5)
+HTTP_RETRY_STATUSES = (500, 502, 503, 504)
+
+_sessions: Dict[Tuple[str, str, bool], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _create_session(idempotent: bool = True) -> requests.Session:
+    if idempotent:
+        retry = Retry(
+            total=HTTP_RETRY_TOTAL,
+            connect=HTTP_RETRY_TOTAL,
+            read=HTTP_RETRY_TOTAL,
+            status=HTTP_RETRY_TOTAL,
+            backoff_factor=HTTP_RETRY_BACKOFF,
+            backoff_max=HTTP_RETRY_BACKOFF_MAX,
+            backoff_jitter=HTTP_RETRY_JITTER,
+            status_forcelist=HTTP_RETRY_STATUSES,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+    else:
+        # Запрос мог быть уже принят сервером: повторяем, только если
+        # соединение не установлено и запрос точно не отправлен
+        retry = Retry(
+            total=HTTP_RETRY_TOTAL,
+            connect=HTTP_RETRY_TOTAL,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=HTTP_RETRY_BACKOFF,
+            backoff_max=HTTP_RETRY_BACKOFF_MAX,
+            backoff_jitter=HTTP_RETRY_JITTER,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(url: str, idempotent: bool = True) -> requests.Session:
+    """
+    Возвращает общую keep-alive сессию для хоста из url.
+    Для каждого хоста создается своя сессия со своим пулом соединений;
+    неидемпотентные запросы (idempotent=False) идут через отдельную сессию,
+    которая повторяет их только при ошибках установки соединения.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc, idempotent)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _create_session(idempotent)
+                _sessions[key] = session
+    return session
+
+
+def request(method: str, url: str, idempotent: bool = True, **kwargs) -> requests.Response:
+    """
+    Выполняет HTTP запрос через пул соединений.
+    Если timeout не передан, используются HTTP_CONNECT_TIMEOUT и HTTP_READ_TIMEOUT.
+    Запросы с idempotent=False не повторяются после ошибок чтения и ответов 5xx.
+    """
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session(url, idempotent).request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, idempotent: bool = True, **kwargs) -> requests.Response:
+    return request('POST', url, idempotent=idempotent, **kwargs)
+
+
+def put(url: str, **kwargs) -> requests.Response:
+    return request('PUT', url, **kwargs)
@@ -0,0 +1,62 @@
+import os
+from array import array
+from typing import Iterable
+
+from django.conf import settings
+
+# Каталог для служебных файлов рассылок (снимки аудиторий, доставки, кэш сегментов).
+# Веб-процессу и check_mailings общий каталог не нужен: все, что передается между
+# ними (поколение снимка, состав пакетов для учета доставок), хранится в базе.
+# Обработчики на нескольких хостах должны делить каталог: иначе рассылка,
+# перехваченная другим хостом, строит снимок заново, а ограничение частоты
+# считается по доставкам каждого хоста отдельно
+MAILING_DATA_DIR = getattr(
+    settings,
+    'MAILING_DATA_DIR',
+    os.path.join(str(getattr(settings, 'BASE_DIR', '.')), 'mailing_data')
+)
+
+
+def data_path(*parts: str) -> str:
+    """
+    Путь внутри MAILING_DATA_DIR; недостающие каталоги создаются.
+    """
+    path = os.path.join(MAILING_DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def to_int_ids(user_ids: Iterable) -> array:
+    """
+    Приводит id пользователей (числа или строки из /users/filter) к array('q').
+    Нечисловые значения пропускаются.
+    """
+    ids = array('q')
+    for user_id in user_ids:
+        try:
+            ids.append(int(user_id))
+        except (TypeError, ValueError):
+            continue
+    return ids
+
+
+def write_ids(path: str, ids: array) -> None:
+    """
+    Атомарно записывает массив int64 в файл.
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        ids.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_ids(path: str) -> array:
+    """
+    Читает массив int64 из файла; для отсутствующего файла возвращает пустой массив.
+    """
+    ids = array('q')
+    if not os.path.exists(path):
+        return ids
+    with open(path, 'rb') as f:
+        ids.frombytes(f.read())
+    return ids
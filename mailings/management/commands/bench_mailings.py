@@ -0,0 +1,204 @@
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from mailings import api, id_store, metrics
+from mailings.batch_sizer import batch_sizer
+from mailings.dispatcher import Dispatcher, MAILING_DISPATCHER_WORKERS
+from mailings.fair_queue import send_queue
+from mailings.fake_upstream import FakeUpstream
+from mailings.models import Mailing
+
+# Границы корзин задержек на время замера: шаг 10% от 1 мс до ~2 мин,
+# чтобы процентили не огрублялись стандартными корзинами
+_BENCH_BUCKETS = tuple(0.001 * 1.1 ** i for i in range(123))
+
+_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест отправки рассылок: поднимает локальные заглушки сервиса '
+        'пользователей и бота, отправляет рассылки обработчиком во временной базе '
+        'и выводит пропускную способность, задержки пакетов и пиковую память'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--audience', type=int, default=100000, help='Количество пользователей в выборке')
+        parser.add_argument('--mailings', type=int, default=1, help='Количество одновременных рассылок')
+        parser.add_argument('--workers', type=int, default=MAILING_DISPATCHER_WORKERS, help='Потоки обработчика')
+        parser.add_argument('--users-latency', type=float, default=50, help='Задержка /users/filter (мс)')
+        parser.add_argument('--broadcast-latency', type=float, default=100, help='Задержка /broadcast (мс)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Доля запросов, получающих 503')
+        parser.add_argument(
+            '--send-rate',
+            type=float,
+            default=0,
+            help='Ограничение отправки (сообщений в секунду); 0 - без ограничения'
+        )
+        parser.add_argument(
+            '--no-payloads',
+            action='store_true',
+            help='Бот не поддерживает PUT /payloads: сообщения передаются в каждом пакете'
+        )
+        parser.add_argument('--timeout', type=float, default=600, help='Максимальное время теста (секунды)')
+        parser.add_argument('--tracemalloc', action='store_true', help='Замерять пиковую память Python (медленнее)')
+        parser.add_argument('--json', action='store_true', help='Вывести результат в JSON')
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            logging.getLogger('mailings').setLevel(logging.WARNING)
+
+        work_dir = tempfile.mkdtemp(prefix='mailing-bench-')
+        id_store.MAILING_DATA_DIR = os.path.join(work_dir, 'data')
+        send_queue.bucket.rate = options['send_rate']
+        metrics.upstream_request_seconds.buckets = _BENCH_BUCKETS
+
+        connection = connections['default']
+        if connection.vendor == 'sqlite':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(work_dir, 'bench.sqlite3')
+            # Потоки обработчика забирают рассылки одновременно: транзакции сразу
+            # берут блокировку записи и ждут ее, а не падают с "database is locked"
+            options_dict = connection.settings_dict.setdefault('OPTIONS', {})
+            options_dict.setdefault('timeout', 30)
+            options_dict.setdefault('transaction_mode', 'IMMEDIATE')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        upstream = FakeUpstream(
+            audience=options['audience'],
+            users_latency=options['users_latency'] / 1000,
+            broadcast_latency=options['broadcast_latency'] / 1000,
+            error_rate=options['error_rate'],
+            payloads=not options['no_payloads']
+        )
+        url = upstream.start()
+        api.AUTH_URL = url
+        try:
+            with override_settings(BROADCAST_URL=url, ENABLE_MAILING_CHECK=True):
+                result = self._run(options)
+        finally:
+            upstream_stats = upstream.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        result['upstream'] = upstream_stats
+        if options['json']:
+            self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+        else:
+            self._print(result)
+
+    def _run(self, options):
+        user = get_user_model().objects.create(username='mailing-bench')
+        mailing_ids = [
+            Mailing.objects.create(
+                title=f'Нагрузочный тест {i + 1}',
+                text='Нагрузочный тест рассылки',
+                scheduled_at=timezone.now(),
+                created_by=user
+            ).pk
+            for i in range(options['mailings'])
+        ]
+        finished_statuses = [Mailing.Status.COMPLETED, Mailing.Status.FAILED]
+
+        if options['tracemalloc']:
+            tracemalloc.start()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        dispatcher = Dispatcher(workers=options['workers'])
+        started_at = time.monotonic()
+        dispatcher.start()
+        try:
+            while time.monotonic() - started_at < options['timeout']:
+                finished = Mailing.objects.filter(pk__in=mailing_ids, status__in=finished_statuses).count()
+                if finished == len(mailing_ids):
+                    break
+                time.sleep(0.05)
+            elapsed = time.monotonic() - started_at
+        finally:
+            dispatcher.stop()
+            dispatcher.join()
+
+        traced_peak = None
+        if options['tracemalloc']:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        statuses = dict.fromkeys(Mailing.Status.values, 0)
+        for status in Mailing.objects.filter(pk__in=mailing_ids).values_list('status', flat=True):
+            statuses[status] += 1
+
+        users_sent = metrics.users_sent.value()
+        return {
+            'options': {
+                name: options[name] for name in (
+                    'audience', 'mailings', 'workers', 'users_latency', 'broadcast_latency',
+                    'error_rate', 'send_rate', 'no_payloads'
+                )
+            },
+            'elapsed_seconds': round(elapsed, 3),
+            'mailings': {status: count for status, count in statuses.items() if count},
+            'users_sent': users_sent,
+            'users_per_second': round(users_sent / elapsed, 1) if elapsed else 0,
+            'batches_sent': metrics.batches_sent.value(),
+            'final_batch_size': batch_sizer.size,
+            'latency_seconds': {
+                upstream: {
+                    'count': metrics.upstream_request_seconds.count(upstream=upstream),
+                    **{
+                        f'p{round(q * 100)}': round(metrics.upstream_request_seconds.quantile(q, upstream=upstream), 4)
+                        for q in _QUANTILES
+                    },
+                }
+                for upstream in ('broadcast', 'users_filter')
+            },
+            'upstream_errors': {
+                upstream: metrics.upstream_errors.value(upstream=upstream)
+                for upstream in ('auth', 'users_filter', 'payloads', 'broadcast')
+            },
+            'memory': {
+                # ru_maxrss в Linux - килобайты
+                'rss_before_mb': round(rss_before / 1024, 1),
+                'rss_peak_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                'tracemalloc_peak_mb': round(traced_peak / 1024 / 1024, 1) if traced_peak is not None else None,
+            },
+        }
+
+    def _print(self, result):
+        write = self.stdout.write
+        write(f"Рассылки: {result['mailings']}, время: {result['elapsed_seconds']} с")
+        write(
+            f"Отправлено пользователей: {result['users_sent']} "
+            f"({result['users_per_second']} в секунду), пакетов: {result['batches_sent']}, "
+            f"итоговый размер пакета: {result['final_batch_size']}"
+        )
+        for upstream, latency in result['latency_seconds'].items():
+            percentiles = ', '.join(
+                f'{name}={value * 1000:.1f} мс' for name, value in latency.items() if name != 'count'
+            )
+            write(f"Задержка {upstream} ({latency['count']} запросов): {percentiles}")
+        write(f"Ошибки запросов: {result['upstream_errors']}")
+        memory = result['memory']
+        line = f"Память: RSS до отправки {memory['rss_before_mb']} МБ, пиковый RSS {memory['rss_peak_mb']} МБ"
+        if memory['tracemalloc_peak_mb'] is not None:
+            line += f", пик tracemalloc {memory['tracemalloc_peak_mb']} МБ"
+        write(line)
+        upstream = result['upstream']
+        write(
+            f"Бот: получено пользователей {upstream['users_received']}, уникальных {upstream['unique_users']}, "
+            f"повторов {upstream['duplicate_users']}, внесенных ошибок {upstream['injected_errors']}"
+        )
+        if result['mailings'].get(Mailing.Status.COMPLETED) == result['options']['mailings']:
+            write(self.style.SUCCESS('Все рассылки отправлены'))
+        else:
+            write(self.style.WARNING('Не все рассылки завершены'))
@@ -0,0 +1,124 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+
+from mailings.models import PERMANENT_DELIVERY_ERRORS, MailingBatch, MailingFailure, SuppressedUser
+from mailings.status_buffer import build_failures, update_error_stats
+from mailings.suppression import suppress_failures
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит ошибки из устаревшего поля MailingBatch.error_details в MailingFailure '
+        'и MailingErrorStat, а постоянные ошибки из MailingFailure - в SuppressedUser. '
+        'Запускать после migrate и до миграции, удаляющей столбец error_details'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Пакетов за одну транзакцию')
+
+    def handle(self, *args, **options):
+        self.fill_suppressed_users(options['chunk_size'])
+
+        table = MailingBatch._meta.db_table
+        with connection.cursor() as cursor:
+            columns = [column.name for column in connection.introspection.get_table_description(cursor, table)]
+        if 'error_details' not in columns:
+            self.stdout.write('Столбец error_details уже удален, переносить нечего')
+            return
+
+        quote = connection.ops.quote_name
+        select = (
+            f'SELECT {quote("id")}, {quote("mailing_id")}, {quote("batch_number")}, '
+            f'{quote("error_details")} FROM {quote(table)} '
+            f'WHERE {quote("error_details")} IS NOT NULL AND {quote("id")} > %s '
+            f'ORDER BY {quote("id")} LIMIT %s'
+        )
+        clear = f'UPDATE {quote(table)} SET {quote("error_details")} = NULL WHERE {quote("id")} = %s'
+
+        converted = failures_count = 0
+        last_id = 0
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(select, [last_id, options['chunk_size']])
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                # Пакеты, о которых бот уже отчитался в новом формате, не трогаем
+                reported = set(MailingFailure.objects.filter(
+                    mailing_id__in={row[1] for row in rows},
+                    batch_number__in={row[2] for row in rows}
+                ).values_list('mailing_id', 'batch_number').distinct())
+
+                failures = []
+                for batch_id, mailing_id, batch_number, details in rows:
+                    if (mailing_id, batch_number) not in reported:
+                        if isinstance(details, str):
+                            details = json.loads(details)
+                        batch_failures = build_failures({
+                            'mailing_id': mailing_id,
+                            'batch_number': batch_number,
+                            'error_details': details if isinstance(details, list) else [],
+                        })
+                        failures.extend(batch_failures)
+                    cursor.execute(clear, [batch_id])
+
+                MailingFailure.objects.bulk_create(failures, batch_size=1000)
+                # auto_now_add ставит время переноса: возвращаем время пакета,
+                # чтобы старые ошибки не попали в окно списка исключений
+                batches = MailingBatch.objects.filter(pk__in=[row[0] for row in rows])
+                for mailing_id, batch_number, created_at in batches.values_list('mailing_id', 'batch_number', 'created_at'):
+                    if (mailing_id, batch_number) not in reported:
+                        MailingFailure.objects.filter(
+                            mailing_id=mailing_id, batch_number=batch_number
+                        ).update(created_at=created_at)
+                        suppress_failures(
+                            [
+                                failure for failure in failures
+                                if failure.mailing_id == mailing_id and failure.batch_number == batch_number
+                            ],
+                            created_at,
+                            keep_existing=True
+                        )
+
+                deltas = {}
+                for failure in failures:
+                    key = (failure.mailing_id, failure.error_code)
+                    deltas[key] = deltas.get(key, 0) + 1
+                update_error_stats(deltas)
+
+            converted += len(rows)
+            failures_count += len(failures)
+            self.stdout.write(f'Обработано пакетов: {converted}, перенесено ошибок: {failures_count}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Готово: пакетов {converted}, ошибок {failures_count}. Теперь можно удалить столбец error_details'
+        ))
+
+    def fill_suppressed_users(self, chunk_size):
+        """
+        Заносит в SuppressedUser пользователей с постоянными ошибками, записанными
+        в MailingFailure до появления таблицы; уже занесенные не меняются.
+        """
+        rows = MailingFailure.objects.filter(
+            error_code__in=PERMANENT_DELIVERY_ERRORS
+        ).values('user_id').annotate(
+            code=Max('error_code'), last_failed_at=Max('created_at')
+        ).order_by('user_id')
+
+        chunk, filled = [], 0
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(SuppressedUser(
+                user_id=row['user_id'], error_code=row['code'], failed_at=row['last_failed_at']
+            ))
+            if len(chunk) >= chunk_size:
+                SuppressedUser.objects.bulk_create(chunk, ignore_conflicts=True)
+                filled += len(chunk)
+                chunk = []
+        SuppressedUser.objects.bulk_create(chunk, ignore_conflicts=True)
+        filled += len(chunk)
+        self.stdout.write(f'Пользователей с постоянными ошибками: {filled}')
@@ -0,0 +1,221 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы корзин гистограмм времени (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry: List['_Metric'] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f'{self.name}{_format_labels(self._labels(key))} {value}')
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма в формате Prometheus: накопительные корзины, сумма и количество.
+    quantile() оценивает квантиль по корзинам так же, как histogram_quantile.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # По каждой метке: количество в корзинах (последняя - +Inf), сумма
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started_at, **labels)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], [0.0]))
+        return sum(counts)
+
+    def quantile(self, q: float, **labels) -> float:
+        """
+        Оценка квантиля q (0..1) линейной интерполяцией внутри корзины.
+        Если квантиль попал в корзину +Inf, возвращается верхняя конечная граница.
+        """
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([], [0.0]))
+            counts = list(counts)
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{self.name}_bucket{_format_labels({**labels, "le": le})} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    """
+    Все метрики процесса в текстовом формате Prometheus.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram(
+    'mailing_stage_seconds',
+    'Время этапов обработки рассылки (claim, snapshot, payload_build)',
+    ['stage']
+)
+upstream_request_seconds = Histogram(
+    'mailing_upstream_request_seconds',
+    'Время запросов к внешним сервисам',
+    ['upstream']
+)
+upstream_errors = Counter(
+    'mailing_upstream_errors_total',
+    'Ошибки запросов к внешним сервисам',
+    ['upstream']
+)
+batches_sent = Counter('mailing_batches_sent_total', 'Пакеты, принятые ботом')
+users_sent = Counter('mailing_users_sent_total', 'Пользователи в пакетах, принятых ботом')
+users_skipped = Counter(
+    'mailing_users_skipped_total',
+    'Пользователи, исключенные из рассылки',
+    ['reason']
+)
+status_reports = Counter('mailing_status_reports_total', 'Отчеты бота о пакетах')
+status_callback_lag_seconds = Histogram(
+    'mailing_status_callback_lag_seconds',
+    'Время от отправки пакета до первого отчета бота о нем'
+)
+
+
+@contextmanager
+def upstream_request(upstream: str):
+    """
+    Замеряет запрос к внешнему сервису; исключение учитывается как ошибка.
+    """
+    started_at = time.monotonic()
+    try:
+        yield
+    except Exception:
+        upstream_errors.inc(upstream=upstream)
+        raise
+    finally:
+        upstream_request_seconds.observe(time.monotonic() - started_at, upstream=upstream)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, address: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """
+    Отдает метрики процесса по HTTP в отдельном потоке (для процессов
+    без веб-сервера, например check_mailings).
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -1,9 +1,48 @@
-from django.db import models
+from datetime import timedelta
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.conf import settings
+from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.validators import FileExtensionValidator
+import hashlib
 import os
+from .snapshot import AudienceSnapshot, delete_sent_ids
+
+
+AUDIENCE_OPERATORS = ('union', 'intersect', 'exclude')
+
+
+def validate_audience_expression(expression, path='выражение'):
+    """
+    Проверяет составную аудиторию. Узел - словарь с одним ключом:
+    {"filters": {...} | null} - пользователи по фильтрам (null - фильтры рассылки),
+    {"mailing": id} - получатели прошлой рассылки,
+    {"union" | "intersect" | "exclude": [узлы]} - объединение, пересечение,
+    первый узел без остальных.
+    """
+    if expression in (None, {}):
+        return
+    if not isinstance(expression, dict) or len(expression) != 1:
+        raise ValidationError(f'{path}: узел должен быть словарем с одним ключом')
+
+    operator, operand = next(iter(expression.items()))
+    if operator == 'filters':
+        if operand is not None and not isinstance(operand, dict):
+            raise ValidationError(f'{path}: "filters" должен быть словарем фильтров или null')
+    elif operator == 'mailing':
+        if not isinstance(operand, int) or isinstance(operand, bool):
+            raise ValidationError(f'{path}: "mailing" должен быть id рассылки')
+    elif operator in AUDIENCE_OPERATORS:
+        if not isinstance(operand, list) or not operand:
+            raise ValidationError(f'{path}: "{operator}" должен быть непустым списком узлов')
+        for index, child in enumerate(operand):
+            if child in (None, {}):
+                raise ValidationError(f'{path}.{operator}[{index}]: пустой узел')
+            validate_audience_expression(child, f'{path}.{operator}[{index}]')
+    else:
+        raise ValidationError(f'{path}: неизвестная операция "{operator}"')
 
 
 def mailing_media_path(instance, filename):
@@ -14,6 +53,94 @@ def mailing_media_path(instance, filename):
     return f'mailings/{instance.mailing.id}/{instance.media_type}/{filename}'
 
 
+class MailingQuerySet(models.QuerySet):
+    def claimable(self, now=None):
+        """
+        Рассылки, которые можно взять в обработку: ожидающие, время которых
+        наступило, и обрабатываемые, аренда которых истекла (обработчик упал)
+        или не была записана (оставлены обработчиком без аренд).
+        """
+        now = now or timezone.now()
+        return self.filter(
+            Q(status=Mailing.Status.PENDING, scheduled_at__lte=now) |
+            Q(status=Mailing.Status.PROCESSING, lease_expires_at__lt=now) |
+            Q(status=Mailing.Status.PROCESSING, lease_expires_at__isnull=True)
+        )
+
+    def claim(self, owner, lease_seconds, limit=1):
+        """
+        Атомарно забирает до limit рассылок в обработку.
+
+        Строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому
+        несколько процессов (и хостов) разбирают разные рассылки без гонок.
+
+        Returns:
+            List[Mailing]: захваченные рассылки
+        """
+        now = timezone.now()
+        lease_expires_at = now + timedelta(seconds=lease_seconds)
+
+        with transaction.atomic():
+            mailings = list(
+                self.claimable(now)
+                .select_for_update(skip_locked=True)
+                .order_by('-priority', 'scheduled_at')[:limit]
+            )
+            if not mailings:
+                return []
+
+            self.filter(pk__in=[mailing.pk for mailing in mailings]).update(
+                status=Mailing.Status.PROCESSING,
+                lease_owner=owner,
+                lease_expires_at=lease_expires_at
+            )
+
+        for mailing in mailings:
+            mailing.status = Mailing.Status.PROCESSING
+            mailing.lease_owner = owner
+            mailing.lease_expires_at = lease_expires_at
+        return mailings
+
+    def renew_lease(self, pk, owner, lease_seconds):
+        """
+        Продлевает аренду рассылки. Возвращает False, если аренда потеряна.
+        """
+        return self.filter(
+            pk=pk,
+            status=Mailing.Status.PROCESSING,
+            lease_owner=owner
+        ).update(
+            lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds)
+        ) > 0
+
+    def abandon(self, pk, owner, retry_at=None, **fields):
+        """
+        Отказывается от аренды, не меняя статус и контрольную точку: рассылку
+        сможет забрать другой обработчик - сразу или, если передан retry_at,
+        не раньше этого времени.
+        """
+        return self.filter(pk=pk, lease_owner=owner).update(
+            lease_owner=None,
+            lease_expires_at=retry_at or timezone.now(),
+            **fields
+        ) > 0
+
+    def release(self, pk, owner, status, **fields):
+        """
+        Снимает аренду и переводит рассылку в итоговый статус.
+        Обрабатываемая рассылка без аренды не будет забрана снова,
+        поэтому вернуть ее в обработку нельзя (для этого есть abandon).
+        """
+        if status in (Mailing.Status.PENDING, Mailing.Status.PROCESSING):
+            raise ValueError(f'Рассылку нельзя освободить в статусе {status}')
+        return self.filter(pk=pk, lease_owner=owner).update(
+            status=status,
+            lease_owner=None,
+            lease_expires_at=None,
+            **fields
+        ) > 0
+
+
 class Mailing(models.Model):
     class Status(models.TextChoices):
         PENDING = 'pending', 'Ожидает отправки'
@@ -31,6 +158,13 @@ class Mailing(models.Model):
         ANIMATION = 'animation', 'Анимация'        # send_animation
         VIDEO_NOTE = 'video_note', 'Видео-кружок'  # send_video_note
 
+    class Priority(models.IntegerChoices):
+        # Значение - вес рассылки при распределении пропускной способности бота
+        LOW = 1, 'Низкий'
+        NORMAL = 4, 'Обычный'
+        HIGH = 16, 'Высокий'
+        URGENT = 64, 'Срочный'
+
     class ParseMode(models.TextChoices):
         NONE = 'NONE', 'Без форматирования'
         HTML = 'HTML', 'HTML'  
@@ -76,6 +210,18 @@ class Mailing(models.Model):
         default=dict
     )
 
+    audience_expression = models.JSONField(
+        verbose_name='Составная аудитория',
+        blank=True,
+        null=True,
+        validators=[validate_audience_expression],
+        help_text=(
+            'Необязательно. Например, {"exclude": [{"filters": null}, {"mailing": 12}]} - '
+            'пользователи по фильтрам рассылки, кроме получателей рассылки 12. '
+            'Операции: union, intersect, exclude; листья: filters, mailing'
+        )
+    )
+
     reply_markup = models.JSONField(
         verbose_name='Клавиатура',
         blank=True,
@@ -86,6 +232,13 @@ class Mailing(models.Model):
     scheduled_at = models.DateTimeField(
         verbose_name='Время отправки'
     )
+
+    priority = models.PositiveSmallIntegerField(
+        choices=Priority.choices,
+        default=Priority.NORMAL,
+        verbose_name='Приоритет',
+        help_text='Рассылки с более высоким приоритетом забираются первыми и получают большую долю отправки'
+    )
     
     created_at = models.DateTimeField(
         auto_now_add=True,
@@ -117,21 +270,97 @@ class Mailing(models.Model):
         verbose_name='Сообщение об ошибке'
     )
 
+    lease_owner = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        verbose_name='Обработчик',
+        help_text='Процесс, который сейчас отправляет рассылку'
+    )
+
+    lease_expires_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        verbose_name='Аренда до',
+        help_text='Если обработчик не продлит аренду до этого времени, рассылку заберет другой'
+    )
+
+    batch_size = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        verbose_name='Размер пакета',
+        help_text='Размер последнего принятого ботом пакета; подбирается автоматически'
+    )
+
+    total_batches = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Всего пакетов'
+    )
+
+    last_dispatched_batch = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Последний отправленный пакет',
+        help_text='Все пакеты до этого номера включительно приняты ботом'
+    )
+
+    dispatch_offset = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Передано пользователей',
+        help_text='Количество пользователей в пакетах до контрольной точки'
+    )
+
+    audience_size = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        verbose_name='Размер аудитории',
+        help_text='Количество уникальных пользователей в снимке аудитории'
+    )
+
+    audience_position = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Позиция в аудитории',
+        help_text='Сколько пользователей снимка аудитории пройдено до контрольной точки (включая исключенных)'
+    )
+
+    snapshot_generation = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Поколение снимка аудитории',
+        help_text='Увеличивается при перезапуске: снимки прошлых поколений не используются'
+    )
+
+    successful_users_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Успешно отправлено',
+        help_text='Сумма по всем пакетам, обновляется при получении статуса пакета'
+    )
+
+    failed_users_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Ошибки отправки',
+        help_text='Сумма по всем пакетам, обновляется при получении статуса пакета'
+    )
+
+    objects = MailingQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Рассылка'
         verbose_name_plural = 'Рассылки'
         ordering = ['-scheduled_at']
+        indexes = [
+            models.Index(fields=['status', 'scheduled_at']),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.get_status_display()})"
 
     @property
     def total_successful_users(self):
-        return sum(batch.successful_users for batch in self.batches.all())
+        return self.successful_users_count
 
     @property 
     def total_failed_users(self):
-        return sum(batch.failed_users for batch in self.batches.all())
+        return self.failed_users_count
 
     def clean(self):
         # Проверяем, сохранен ли объект
@@ -149,9 +378,42 @@ class Mailing(models.Model):
             if active_buttons and not self.text:
                 raise ValidationError('Текст сообщения обязателен при наличии кнопок')
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.batches.all().delete()
+    def restart(self):
+        """
+        Сбрасывает статистику доставки, контрольную точку отправки и снимок
+        аудитории (при повторной отправке аудитория выбирается заново)
+        и ставит рассылку в очередь на повторную отправку.
+
+        Снимок сбрасывается увеличением snapshot_generation: обработчик на другом
+        хосте не видит удаления файлов, но не возьмет снимок прошлого поколения.
+        """
+        with transaction.atomic():
+            generation = self.snapshot_generation
+            transaction.on_commit(AudienceSnapshot.for_mailing(self.pk, generation).delete)
+            transaction.on_commit(lambda: delete_sent_ids(self.pk, generation))
+            self.batches.all().delete()
+            self.failures.all().delete()
+            self.error_stats.all().delete()
+
+            self.status = Mailing.Status.PENDING
+            self.error_message = None
+            self.lease_owner = None
+            self.lease_expires_at = None
+            self.batch_size = None
+            self.total_batches = 0
+            self.last_dispatched_batch = 0
+            self.dispatch_offset = 0
+            self.audience_size = None
+            self.audience_position = 0
+            self.snapshot_generation = generation + 1
+            self.successful_users_count = 0
+            self.failed_users_count = 0
+            self.save(update_fields=[
+                'status', 'error_message', 'lease_owner', 'lease_expires_at',
+                'batch_size', 'total_batches', 'last_dispatched_batch',
+                'dispatch_offset', 'audience_size', 'audience_position', 'snapshot_generation',
+                'successful_users_count', 'failed_users_count', 'updated_at',
+            ])
 
 
 class MailingMedia(models.Model):
@@ -215,6 +477,24 @@ class MailingMedia(models.Model):
         help_text='Порядок отображения в группе медиафайлов'
     )
 
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        editable=False,
+        verbose_name='Хэш содержимого',
+        help_text='SHA-256 файла; одинаковые файлы хранятся один раз'
+    )
+
+    telegram_file_id = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        editable=False,
+        verbose_name='Telegram file_id',
+        help_text='Идентификатор уже загруженного в Telegram файла, сообщается ботом'
+    )
+
     class Meta:
         verbose_name = 'Медиафайл '
         verbose_name_plural = 'Медиафайлы'
@@ -261,15 +541,40 @@ class MailingMedia(models.Model):
                 f'для типа {self.get_media_type_display()}'
             )
 
+    @staticmethod
+    def compute_hash(file):
+        digest = hashlib.sha256()
+        file.seek(0)
+        for chunk in file.chunks():
+            digest.update(chunk)
+        file.seek(0)
+        return digest.hexdigest()
+
     def save(self, *args, **kwargs):
         self.clean()
+
+        # Новый загруженный файл: считаем хэш и, если такой файл уже есть,
+        # ссылаемся на него вместо сохранения копии
+        if self.file and not self.file._committed:
+            self.content_hash = self.compute_hash(self.file)
+            self.telegram_file_id = None
+
+            duplicate = MailingMedia.objects.filter(
+                content_hash=self.content_hash
+            ).exclude(pk=self.pk).order_by(F('telegram_file_id').desc(nulls_last=True)).first()
+            if duplicate and duplicate.file and self.file.storage.exists(duplicate.file.name):
+                self.file = duplicate.file.name
+                if duplicate.media_type == self.media_type:
+                    self.telegram_file_id = duplicate.telegram_file_id
+
         super().save(*args, **kwargs)
         
 
     def delete(self, *args, **kwargs):
-        # Удаляем файл при удалении записи
+        # Удаляем файл при удалении записи, если на него не ссылаются другие медиафайлы
         if self.file:
-            if os.path.isfile(self.file.path):
+            shared = MailingMedia.objects.filter(file=self.file.name).exclude(pk=self.pk).exists()
+            if not shared and os.path.isfile(self.file.path):
                 os.remove(self.file.path)
         super().delete(*args, **kwargs)
 
@@ -355,11 +660,34 @@ class MailingBatch(models.Model):
         default=0
     )
 
+    sent_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Время отправки в бот'
+    )
+
+    reported_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Время отчета бота'
+    )
+
+    # Состав пакета (id int64) для ограничения частоты рассылок: записывается
+    # при постановке пакета в очередь и стирается, когда доставки учтены
+    user_ids = models.BinaryField(
+        null=True,
+        blank=True,
+        verbose_name='Состав пакета'
+    )
+
+    # Устарело: ошибки хранятся в MailingFailure. Поле удаляется только после того,
+    # как команда convert_error_details перенесет старые записи на всех окружениях
     error_details = models.JSONField(
         verbose_name='Детали ошибок',
         null=True,
         blank=True,
-        help_text='Список ошибок при отправке'
+        editable=False,
+        help_text='Устарело, см. MailingFailure'
     )
 
     created_at = models.DateTimeField(
@@ -374,4 +702,200 @@ class MailingBatch(models.Model):
         unique_together = [('mailing', 'batch_number')]
 
     def __str__(self):
-        return f"Пакет {self.batch_number} рассылки {self.mailing.title}"
\ No newline at end of file
+        return f"Пакет {self.batch_number} рассылки {self.mailing.title}"
+
+
+class DeliveryError(models.IntegerChoices):
+    UNKNOWN = 0, 'Неизвестная ошибка'
+    BOT_BLOCKED = 1, 'Пользователь заблокировал бота'
+    NOT_DELIVERED = 2, 'Сообщение не доставлено'
+    USER_DEACTIVATED = 3, 'Пользователь удален'
+    CHAT_NOT_FOUND = 4, 'Чат не найден'
+    RATE_LIMITED = 5, 'Превышен лимит запросов'
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Определяет код ошибки по тексту, который прислал бот.
+        """
+        text = str(message or '').strip().lower()
+        for code in cls:
+            if text == code.label.lower():
+                return code
+        for code, phrases in DELIVERY_ERROR_PHRASES.items():
+            if any(phrase in text for phrase in phrases):
+                return code
+        return cls.UNKNOWN
+
+
+# Известные тексты ошибок Telegram Bot API и бота для каждого кода.
+# Сравниваются целые фразы, а не отдельные слова: "Сообщение удалено"
+# не должно считаться удаленным пользователем
+DELIVERY_ERROR_PHRASES = {
+    DeliveryError.BOT_BLOCKED: (
+        'bot was blocked by the user',
+        'пользователь заблокировал бота',
+    ),
+    DeliveryError.USER_DEACTIVATED: (
+        'user is deactivated',
+        'пользователь удален',
+        'пользователь деактивирован',
+    ),
+    DeliveryError.CHAT_NOT_FOUND: (
+        'chat not found',
+        'чат не найден',
+    ),
+    DeliveryError.RATE_LIMITED: (
+        'too many requests',
+        'превышен лимит запросов',
+    ),
+    DeliveryError.NOT_DELIVERED: (
+        'сообщение не доставлено',
+    ),
+}
+
+
+# Ошибки, после которых доставка пользователю невозможна и при следующих рассылках
+PERMANENT_DELIVERY_ERRORS = (
+    DeliveryError.BOT_BLOCKED,
+    DeliveryError.USER_DEACTIVATED,
+    DeliveryError.CHAT_NOT_FOUND,
+)
+
+
+class MailingFailure(models.Model):
+    """Ошибка доставки рассылки конкретному пользователю"""
+
+    mailing = models.ForeignKey(
+        Mailing,
+        on_delete=models.CASCADE,
+        related_name='failures',
+        verbose_name='Рассылка'
+    )
+
+    batch_number = models.PositiveIntegerField(
+        verbose_name='Номер пакета'
+    )
+
+    user_id = models.BigIntegerField(
+        verbose_name='Пользователь'
+    )
+
+    error_code = models.PositiveSmallIntegerField(
+        choices=DeliveryError.choices,
+        default=DeliveryError.UNKNOWN,
+        verbose_name='Ошибка'
+    )
+
+    error_text = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        verbose_name='Текст ошибки',
+        help_text='Сохраняется только для нераспознанных ошибок'
+    )
+
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Время создания'
+    )
+
+    class Meta:
+        verbose_name = 'Ошибка доставки'
+        verbose_name_plural = 'Ошибки доставки'
+        indexes = [
+            models.Index(fields=['mailing', 'batch_number']),
+            models.Index(fields=['mailing', 'error_code']),
+            models.Index(fields=['user_id', 'error_code']),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.get_error_code_display()}"
+
+
+class SuppressedUser(models.Model):
+    """
+    Пользователь с постоянной ошибкой доставки (PERMANENT_DELIVERY_ERRORS):
+    последняя такая ошибка по всем рассылкам. В отличие от MailingFailure
+    не удаляется при перезапуске рассылки; см. suppression.SuppressionList.
+    """
+
+    user_id = models.BigIntegerField(
+        unique=True,
+        verbose_name='Пользователь'
+    )
+
+    error_code = models.PositiveSmallIntegerField(
+        choices=DeliveryError.choices,
+        verbose_name='Ошибка'
+    )
+
+    failed_at = models.DateTimeField(
+        db_index=True,
+        verbose_name='Время ошибки'
+    )
+
+    class Meta:
+        verbose_name = 'Исключенный пользователь'
+        verbose_name_plural = 'Исключенные пользователи'
+
+    def __str__(self):
+        return f"{self.user_id}: {self.get_error_code_display()}"
+
+
+class MailingErrorStat(models.Model):
+    """Количество ошибок доставки рассылки по кодам"""
+
+    mailing = models.ForeignKey(
+        Mailing,
+        on_delete=models.CASCADE,
+        related_name='error_stats',
+        verbose_name='Рассылка'
+    )
+
+    error_code = models.PositiveSmallIntegerField(
+        choices=DeliveryError.choices,
+        verbose_name='Ошибка'
+    )
+
+    count = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество'
+    )
+
+    class Meta:
+        verbose_name = 'Статистика ошибок'
+        verbose_name_plural = 'Статистика ошибок'
+        unique_together = [('mailing', 'error_code')]
+
+    def __str__(self):
+        return f"{self.get_error_code_display()}: {self.count}"
+
+
+class MailingSendBudget(models.Model):
+    """
+    Общий запас токенов лимита отправки в бот (MAILING_SEND_RATE) для всех
+    процессов-обработчиков; см. fair_queue.SharedTokenBucket.
+    """
+
+    key = models.CharField(
+        max_length=64,
+        unique=True,
+        verbose_name='Ключ'
+    )
+
+    tokens = models.FloatField(
+        default=0,
+        verbose_name='Запас токенов'
+    )
+
+    updated_at = models.DateTimeField(
+        verbose_name='Время пополнения'
+    )
+
+    class Meta:
+        verbose_name = 'Лимит отправки'
+        verbose_name_plural = 'Лимиты отправки'
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.0f}"
@@ -0,0 +1,211 @@
+import heapq
+import logging
+import select
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+# Как часто сверять расписание с базой на случай пропущенных сигналов (секунды)
+MAILING_RECONCILE_INTERVAL = getattr(settings, 'MAILING_RECONCILE_INTERVAL', 300)
+# Канал PostgreSQL NOTIFY об изменении рассылок (для обработчиков в других процессах)
+MAILING_NOTIFY_CHANNEL = getattr(settings, 'MAILING_NOTIFY_CHANNEL', 'mailings_schedule')
+# Интервал сверки с базой, если уведомления недоступны (не PostgreSQL)
+MAILING_NOTIFY_FALLBACK_INTERVAL = getattr(settings, 'MAILING_NOTIFY_FALLBACK_INTERVAL', 5)
+
+logger = logging.getLogger(__name__)
+
+
+class MailingScheduler:
+    """
+    Расписание ожидающих рассылок в виде min-heap по времени отправки.
+
+    Поток-обработчик спит до ближайшего scheduled_at и просыпается раньше,
+    если рассылка была создана или изменена (см. mailings.signals).
+    Раз в MAILING_RECONCILE_INTERVAL секунд расписание перечитывается из базы.
+    """
+
+    def __init__(self, reconcile_interval: float = MAILING_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._heap: List[Tuple[float, int]] = []
+        self._condition = threading.Condition()
+        self._next_reconcile = 0.0
+        self._generation = 0
+
+    def schedule(self, mailing_id: int, scheduled_at) -> None:
+        """
+        Добавляет рассылку в расписание и будит ожидающий поток.
+        """
+        with self._condition:
+            heapq.heappush(self._heap, (scheduled_at.timestamp(), mailing_id))
+            self._condition.notify_all()
+
+    def wake(self) -> None:
+        """
+        Будит все ожидающие потоки, даже если ни одна рассылка еще не наступила.
+        """
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def request_reconcile(self) -> None:
+        """
+        Перечитывает расписание из базы при следующем пробуждении и будит потоки.
+        """
+        with self._condition:
+            self._next_reconcile = 0.0
+            self._generation += 1
+            self._condition.notify_all()
+
+    def reconcile(self) -> None:
+        """
+        Перечитывает ожидающие рассылки из базы.
+        """
+        from mailings.models import Mailing
+
+        rows = Mailing.objects.filter(
+            status=Mailing.Status.PENDING
+        ).values_list('scheduled_at', 'pk')
+        # Аренды обрабатываемых рассылок: после истечения их нужно забрать повторно
+        leases = Mailing.objects.filter(
+            status=Mailing.Status.PROCESSING,
+            lease_expires_at__isnull=False
+        ).values_list('lease_expires_at', 'pk')
+        # Обрабатываемые без аренды (оставлены до появления аренд) можно забрать сразу
+        orphaned = Mailing.objects.filter(
+            status=Mailing.Status.PROCESSING,
+            lease_expires_at__isnull=True
+        ).values_list('pk', flat=True)
+        heap = [(due_at.timestamp(), pk) for due_at, pk in [*rows, *leases]]
+        heap.extend((time.time(), pk) for pk in orphaned)
+        heapq.heapify(heap)
+
+        with self._condition:
+            self._heap = heap
+            self._next_reconcile = time.time() + self.reconcile_interval
+
+    def next_due_at(self) -> Optional[float]:
+        with self._condition:
+            return self._heap[0][0] if self._heap else None
+
+    def wait_due(self, timeout: Optional[float] = None) -> List[int]:
+        """
+        Блокируется, пока не наступит время хотя бы одной рассылки,
+        не придет сигнал об изменении расписания или не истечет timeout.
+
+        Returns:
+            List[int]: id рассылок, время которых наступило (могут быть устаревшими,
+            актуальный статус нужно проверять в базе); пустой список после wake()
+            или по истечении timeout
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        generation = self._generation
+
+        while True:
+            now = time.time()
+            if now >= self._next_reconcile:
+                self.reconcile()
+
+            with self._condition:
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[1])
+                if due:
+                    return due
+                if self._generation != generation:
+                    return []
+
+                wait_until = self._next_reconcile
+                if self._heap:
+                    wait_until = min(wait_until, self._heap[0][0])
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait_until = min(wait_until, deadline)
+
+                self._condition.wait(max(0.0, wait_until - now))
+
+
+def notify_schedule(mailing_id: int, scheduled_at) -> None:
+    """
+    Сообщает обработчикам в других процессах об изменении рассылки
+    через PostgreSQL NOTIFY; для других баз ничего не делает
+    (обработчики сверяются с базой каждые MAILING_NOTIFY_FALLBACK_INTERVAL секунд).
+    """
+    connection = connections['default']
+    if connection.vendor != 'postgresql':
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, %s)',
+                [MAILING_NOTIFY_CHANNEL, f'{mailing_id}:{scheduled_at.timestamp()}']
+            )
+    except Exception as e:
+        # Рассылка уже сохранена; обработчик найдет ее при сверке с базой
+        logger.error("Ошибка уведомления об изменении рассылки %s: %s", mailing_id, e)
+
+
+class ScheduleListener:
+    """
+    Получает уведомления notify_schedule (LISTEN) и добавляет рассылки
+    в расписание scheduler, чтобы отдельный обработчик (check_mailings)
+    узнавал о сохранении рассылки в админке без ожидания сверки с базой.
+
+    Если база не PostgreSQL, вместо уведомлений сокращается интервал сверки.
+    После переподключения расписание перечитывается: уведомления,
+    пришедшие без подписки, потеряны.
+    """
+
+    def __init__(self, schedule=None, channel=MAILING_NOTIFY_CHANNEL):
+        self.scheduler = schedule or scheduler
+        self.channel = channel
+        self.stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if connections['default'].vendor != 'postgresql':
+            self.scheduler.reconcile_interval = min(self.scheduler.reconcile_interval, MAILING_NOTIFY_FALLBACK_INTERVAL)
+            return
+        self._thread = threading.Thread(target=self._run, name='mailing-schedule-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def _run(self) -> None:
+        while not self.stop_event.is_set():
+            connection = connections.create_connection('default')
+            try:
+                connection.ensure_connection()
+                connection.set_autocommit(True)
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                self.scheduler.request_reconcile()
+                self._listen(connection.connection)
+            except Exception as e:
+                logger.error("Ошибка подписки на изменения рассылок: %s", e)
+                self.stop_event.wait(5)
+            finally:
+                connection.close()
+
+    def _listen(self, pg_connection) -> None:
+        while not self.stop_event.is_set():
+            if select.select([pg_connection], [], [], 1)[0] == []:
+                continue
+            pg_connection.poll()
+            while pg_connection.notifies:
+                notify = pg_connection.notifies.pop(0)
+                try:
+                    mailing_id, timestamp = notify.payload.split(':')
+                    scheduled_at = datetime.fromtimestamp(float(timestamp), tz=timezone.utc)
+                except ValueError:
+                    self.scheduler.wake()
+                    continue
+                self.scheduler.schedule(int(mailing_id), scheduled_at)
+
+
+scheduler = MailingScheduler()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import threading
+import time
+from typing import Dict
+
+from django.conf import settings
+
+from .id_store import data_path
+
+# Сколько секунд использовать выбранный сегмент повторно; 0 - не кэшировать
+MAILING_SEGMENT_CACHE_TTL = getattr(settings, 'MAILING_SEGMENT_CACHE_TTL', 3600)
+# Максимальный суммарный размер кэша сегментов (байты, 8 байт на пользователя)
+MAILING_SEGMENT_CACHE_MAX_BYTES = getattr(settings, 'MAILING_SEGMENT_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    tmp_path = f'{target}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+class SegmentCache:
+    """
+    Кэш выбранных сегментов: для каждого набора фильтров (по filters_hash)
+    хранится файл отсортированных уникальных id пользователей в формате
+    AudienceSnapshot.
+
+    Время изменения файла - время выборки (по нему считается TTL),
+    время доступа обновляется при каждом использовании; при превышении
+    MAILING_SEGMENT_CACHE_MAX_BYTES удаляются давно не использованные сегменты.
+    Файлы не меняются после записи, поэтому в снимки рассылок они
+    попадают жесткой ссылкой (или копией, если ссылка невозможна).
+    """
+
+    def __init__(self, ttl=MAILING_SEGMENT_CACHE_TTL, max_bytes=MAILING_SEGMENT_CACHE_MAX_BYTES, directory=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            return os.path.join(self.directory, f'{key}.bin')
+        return data_path('segments', f'{key}.bin')
+
+    def lock(self, key: str) -> threading.Lock:
+        """
+        Блокировка выборки сегмента: пока одна рассылка выбирает сегмент,
+        другие с теми же фильтрами ждут и берут его из кэша.
+        """
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, key: str, target: str) -> bool:
+        """
+        Копирует свежий сегмент в target.
+
+        Returns:
+            bool: True, если сегмент найден в кэше
+        """
+        if not self.ttl:
+            return False
+        path = self._path(key)
+        try:
+            modified_at = os.path.getmtime(path)
+            if time.time() - modified_at > self.ttl:
+                os.remove(path)
+                return False
+            _link_or_copy(path, target)
+            os.utime(path, (time.time(), modified_at))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key: str, source: str) -> None:
+        if not self.ttl:
+            return
+        if os.path.getsize(source) > self.max_bytes:
+            return
+        path = self._path(key)
+        _link_or_copy(source, path)
+        os.utime(path)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Удаляет устаревшие сегменты и, пока кэш больше max_bytes,
+        давно не использованные.
+        """
+        directory = os.path.dirname(self._path('_'))
+        entries = []
+        now = time.time()
+        for name in os.listdir(directory):
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                os.remove(path)
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+segment_cache = SegmentCache()
@@ -0,0 +1,26 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Mailing
+from .scheduler import notify_schedule, scheduler
+
+
+@receiver(post_save, sender=Mailing)
+def schedule_mailing(sender, instance, **kwargs):
+    """
+    Будит планировщик после сохранения ожидающей рассылки,
+    чтобы она была отправлена без ожидания следующей сверки с базой.
+    Обработчики в других процессах (check_mailings, другие воркеры gunicorn)
+    узнают о ней через notify_schedule.
+    """
+    if instance.status != Mailing.Status.PENDING or not instance.scheduled_at:
+        return
+
+    mailing_id, scheduled_at = instance.pk, instance.scheduled_at
+
+    def schedule():
+        scheduler.schedule(mailing_id, scheduled_at)
+        notify_schedule(mailing_id, scheduled_at)
+
+    transaction.on_commit(schedule)
@@ -0,0 +1,227 @@
+import glob
+import heapq
+import logging
+import mmap
+import os
+from array import array
+from typing import Iterable, Iterator, List, Tuple
+
+from django.conf import settings
+
+from .id_store import data_path, to_int_ids
+from .metrics import users_skipped
+
+logger = logging.getLogger(__name__)
+
+# Сколько id сортировать в памяти за раз при построении снимка;
+# отсортированные части затем сливаются с диска
+MAILING_SNAPSHOT_RUN_SIZE = getattr(settings, 'MAILING_SNAPSHOT_RUN_SIZE', 1_000_000)
+# Размер страницы /users/filter при построении снимка
+MAILING_SNAPSHOT_PAGE_SIZE = getattr(settings, 'MAILING_SNAPSHOT_PAGE_SIZE', 1000)
+
+# Сколько id читать с диска за раз при слиянии и записи
+_IO_CHUNK = 65536
+
+
+def _iter_file(path: str) -> Iterator[int]:
+    with open(path, 'rb') as f:
+        while True:
+            chunk = array('q')
+            try:
+                chunk.fromfile(f, _IO_CHUNK)
+            except EOFError:
+                pass
+            if not chunk:
+                return
+            yield from chunk
+
+
+def _file_name(mailing_id, generation: int) -> str:
+    # Поколение 0 - файлы, созданные до появления Mailing.snapshot_generation
+    return f'{mailing_id}.bin' if not generation else f'{mailing_id}.{generation}.bin'
+
+
+def sent_ids_path(mailing_id, generation: int = 0) -> str:
+    return data_path('sent', _file_name(mailing_id, generation))
+
+
+def delete_stale_generations(mailing_id, generation: int) -> None:
+    """
+    Удаляет снимок и журнал рассылки, оставшиеся от прошлых поколений
+    (до перезапуска рассылки, возможно на другом хосте).
+    """
+    for directory in ('snapshots', 'sent'):
+        current = data_path(directory, _file_name(mailing_id, generation))
+        pattern = data_path(directory, f'{mailing_id}.*')
+        for path in glob.glob(pattern):
+            if path != current and not path.startswith(f'{current}.'):
+                os.remove(path)
+
+
+def append_sent_ids(mailing_id, user_ids: Iterable, generation: int = 0) -> None:
+    """
+    Дописывает в журнал рассылки пользователей пакета, принятого ботом.
+    Пакеты принимаются не по порядку и после сбоя могут повторяться,
+    поэтому журнал не отсортирован и может содержать повторы.
+    """
+    ids = to_int_ids(user_ids)
+    if not ids:
+        return
+    fd = os.open(sent_ids_path(mailing_id, generation), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, ids.tobytes())
+    finally:
+        os.close(fd)
+
+
+def iter_sent_ids(mailing_id, generation: int = 0) -> Iterator[array]:
+    """
+    Читает журнал принятых ботом пользователей рассылки частями;
+    неполная запись в конце (идет дозапись) отбрасывается.
+    """
+    with open(sent_ids_path(mailing_id, generation), 'rb') as f:
+        while True:
+            data = f.read(_IO_CHUNK * 8)
+            if not data:
+                return
+            chunk = array('q')
+            chunk.frombytes(data[:len(data) // 8 * 8])
+            yield chunk
+
+
+def delete_sent_ids(mailing_id, generation: int = 0) -> None:
+    path = sent_ids_path(mailing_id, generation)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class AudienceSnapshot:
+    """
+    Снимок аудитории рассылки: отсортированный массив уникальных id
+    пользователей (int64) в файле.
+
+    Снимок строится один раз перед отправкой, после чего пакеты читаются
+    из него по позиции, поэтому изменения сегмента во время отправки
+    и сбои /users/filter не приводят к пропускам и дублям, а продолжение
+    после сбоя начинается ровно с сохраненной позиции.
+
+    Построение занимает не больше MAILING_SNAPSHOT_RUN_SIZE id в памяти:
+    части сортируются и записываются отдельно, затем сливаются (k-way merge)
+    с удалением дублей. Чтение идет через mmap.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @classmethod
+    def for_mailing(cls, mailing_id, generation: int = 0) -> 'AudienceSnapshot':
+        """
+        Снимок поколения generation рассылки (Mailing.snapshot_generation):
+        после перезапуска рассылки снимок прошлого поколения не используется,
+        даже если остался на диске другого хоста.
+        """
+        return cls(data_path('snapshots', _file_name(mailing_id, generation)))
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def __len__(self) -> int:
+        if not self.exists():
+            return 0
+        return os.path.getsize(self.path) // 8
+
+    def delete(self) -> None:
+        if self.exists():
+            os.remove(self.path)
+
+    def __iter__(self) -> Iterator[int]:
+        if not self.exists():
+            return iter(())
+        return _iter_file(self.path)
+
+    def write(self, sorted_ids: Iterable[int]) -> int:
+        """
+        Атомарно записывает снимок из возрастающей последовательности id;
+        повторяющиеся подряд id пропускаются.
+
+        Returns:
+            int: количество записанных id
+        """
+        tmp_path = f'{self.path}.tmp'
+        count = 0
+        with open(tmp_path, 'wb') as f:
+            chunk = array('q')
+            previous = None
+            for user_id in sorted_ids:
+                if user_id == previous:
+                    continue
+                previous = user_id
+                chunk.append(user_id)
+                if len(chunk) >= _IO_CHUNK:
+                    chunk.tofile(f)
+                    count += len(chunk)
+                    del chunk[:]
+            chunk.tofile(f)
+            count += len(chunk)
+        os.replace(tmp_path, self.path)
+        return count
+
+    def build(self, pages: Iterable[List], run_size: int = MAILING_SNAPSHOT_RUN_SIZE) -> int:
+        """
+        Строит снимок из страниц пользователей.
+
+        Снимок хранит id как int64: нечисловые id пропускаются,
+        их количество пишется в лог и в mailing_users_skipped_total{reason="invalid_id"}.
+
+        Returns:
+            int: количество уникальных пользователей
+        """
+        runs = []
+        buffer = array('q')
+        invalid = 0
+
+        def flush_run():
+            run_path = f'{self.path}.run{len(runs)}'
+            with open(run_path, 'wb') as f:
+                array('q', sorted(set(buffer))).tofile(f)
+            runs.append(run_path)
+            del buffer[:]
+
+        try:
+            for users in pages:
+                ids = to_int_ids(users)
+                invalid += len(users) - len(ids)
+                buffer.extend(ids)
+                if len(buffer) >= run_size:
+                    flush_run()
+            if buffer or not runs:
+                flush_run()
+            if invalid:
+                users_skipped.inc(invalid, reason='invalid_id')
+                logger.warning("Снимок %s: пропущено %s нечисловых id пользователей", self.path, invalid)
+            return self.write(heapq.merge(*(_iter_file(run_path) for run_path in runs)))
+        finally:
+            for run_path in runs:
+                if os.path.exists(run_path):
+                    os.remove(run_path)
+
+    def iter_blocks(self, start: int = 0, block_size: int = 10000) -> Iterator[Tuple[int, List[int]]]:
+        """
+        Читает снимок блоками, начиная с позиции start.
+
+        Yields:
+            Tuple[int, List[int]]: позиция первого id блока и id пользователей
+        """
+        total = len(self)
+        if start >= total:
+            return
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                ids = view.cast('q')
+                try:
+                    for position in range(start, total, block_size):
+                        yield position, ids[position:position + block_size].tolist()
+                finally:
+                    ids.release()
+                    view.release()
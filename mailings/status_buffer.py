@@ -0,0 +1,260 @@
+import atexit
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import BooleanField, Count, ExpressionWrapper, F, Q
+from django.utils import timezone
+
+from .models import DeliveryError, Mailing, MailingBatch, MailingErrorStat, MailingFailure
+from .metrics import status_callback_lag_seconds, status_reports
+from .suppression import suppress_failures
+
+logger = logging.getLogger(__name__)
+
+# Сбрасывать буфер, когда в нем накопилось столько пакетов
+BROADCAST_STATUS_BUFFER_SIZE = getattr(settings, 'BROADCAST_STATUS_BUFFER_SIZE', 500)
+# И не реже, чем раз в столько секунд
+BROADCAST_STATUS_FLUSH_INTERVAL = getattr(settings, 'BROADCAST_STATUS_FLUSH_INTERVAL', 1.0)
+
+
+def build_failures(report: Dict[str, Any]) -> List[MailingFailure]:
+    """
+    Раскладывает error_details отчета о пакете на записи MailingFailure.
+    Записи без числового user_id пропускаются.
+    """
+    failures = []
+    for detail in report['error_details']:
+        if not isinstance(detail, dict):
+            continue
+        try:
+            user_id = int(detail.get('user_id'))
+        except (TypeError, ValueError):
+            continue
+        error_code = DeliveryError.from_message(detail.get('error'))
+        failures.append(MailingFailure(
+            mailing_id=report['mailing_id'],
+            batch_number=report['batch_number'],
+            user_id=user_id,
+            error_code=error_code,
+            error_text=str(detail.get('error'))[:255] if error_code == DeliveryError.UNKNOWN else None,
+        ))
+    return failures
+
+
+def update_error_stats(deltas: Dict[Tuple[int, int], int]) -> None:
+    """
+    Изменяет счетчики ошибок по рассылкам на переданные приращения.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    MailingErrorStat.objects.bulk_create(
+        [MailingErrorStat(mailing_id=mailing_id, error_code=error_code) for mailing_id, error_code in deltas],
+        ignore_conflicts=True
+    )
+    for (mailing_id, error_code), delta in deltas.items():
+        MailingErrorStat.objects.filter(mailing_id=mailing_id, error_code=error_code).update(
+            count=F('count') + delta
+        )
+
+
+def write_batch_reports(reports: List[Dict[str, Any]]) -> int:
+    """
+    Записывает статусы пакетов одним bulk upsert.
+
+    Счетчики рассылок меняются на разницу с ранее записанными значениями,
+    поэтому повторный отчет о том же пакете не учитывается дважды.
+    Ошибки по пользователям записываются в MailingFailure (при повторном
+    отчете ошибки пакета заменяются), а их количество по кодам - в MailingErrorStat.
+    Пользователи с постоянными ошибками заносятся в SuppressedUser.
+    Отчеты по несуществующим рассылкам отбрасываются.
+
+    По первому отчету о пакете время от его отправки (MailingBatch.sent_at)
+    до отчета учитывается в status_callback_lag_seconds. Доставки для
+    ограничения частоты по отчету учитывает обработчик (delivery_index).
+
+    Returns:
+        int: количество записанных пакетов
+    """
+    if not reports:
+        return 0
+
+    mailing_ids = {report['mailing_id'] for report in reports}
+    batch_numbers = {report['batch_number'] for report in reports}
+
+    with transaction.atomic():
+        existing_ids = set(Mailing.objects.filter(pk__in=mailing_ids).values_list('pk', flat=True))
+        reports = [report for report in reports if report['mailing_id'] in existing_ids]
+        if not reports:
+            return 0
+
+        reported_keys = {(report['mailing_id'], report['batch_number']) for report in reports}
+        rows = [
+            row for row in MailingBatch.objects.select_for_update().filter(
+                mailing_id__in=existing_ids,
+                batch_number__in=batch_numbers
+            ).annotate(
+                has_user_ids=ExpressionWrapper(Q(user_ids__isnull=False), output_field=BooleanField())
+            ).values_list(
+                'mailing_id', 'batch_number', 'successful_users', 'failed_users',
+                'sent_at', 'reported_at', 'has_user_ids'
+            )
+            if (row[0], row[1]) in reported_keys
+        ]
+        # Строка, созданная при постановке или отправке пакета (состав или sent_at
+        # без reported_at), еще не отчет; у пакетов, записанных до появления этих полей, пусто все
+        previous = {
+            (mailing_id, batch_number): (successful, failed)
+            for mailing_id, batch_number, successful, failed, sent_at, reported_at, has_user_ids in rows
+            if reported_at is not None or (sent_at is None and not has_user_ids)
+        }
+        sent_times = {
+            (mailing_id, batch_number): sent_at
+            for mailing_id, batch_number, _, _, sent_at, reported_at, _ in rows
+            if reported_at is None and sent_at is not None
+        }
+
+        reported_at = timezone.now()
+
+        MailingBatch.objects.bulk_create(
+            [
+                MailingBatch(
+                    mailing_id=report['mailing_id'],
+                    batch_number=report['batch_number'],
+                    successful_users=report['successful_users'],
+                    failed_users=report['failed_users'],
+                    reported_at=reported_at,
+                )
+                for report in reports
+            ],
+            update_conflicts=True,
+            unique_fields=['mailing', 'batch_number'],
+            update_fields=['successful_users', 'failed_users', 'reported_at'],
+        )
+
+        error_deltas: Dict[Tuple[int, int], int] = {}
+
+        # Повторно присланные пакеты: убираем их прежние ошибки
+        reported_again = Q()
+        for mailing_id, batch_number in previous:
+            reported_again |= Q(mailing_id=mailing_id, batch_number=batch_number)
+        if previous:
+            stale = MailingFailure.objects.filter(reported_again)
+            for row in stale.values('mailing_id', 'error_code').annotate(count=Count('id')):
+                key = (row['mailing_id'], row['error_code'])
+                error_deltas[key] = error_deltas.get(key, 0) - row['count']
+            stale.delete()
+
+        failures = [failure for report in reports for failure in build_failures(report)]
+        MailingFailure.objects.bulk_create(failures, batch_size=1000)
+        suppress_failures(failures, reported_at)
+        for failure in failures:
+            key = (failure.mailing_id, failure.error_code)
+            error_deltas[key] = error_deltas.get(key, 0) + 1
+        update_error_stats(error_deltas)
+
+        deltas: Dict[int, Tuple[int, int]] = {}
+        for report in reports:
+            successful, failed = previous.get((report['mailing_id'], report['batch_number']), (0, 0))
+            total_successful, total_failed = deltas.get(report['mailing_id'], (0, 0))
+            deltas[report['mailing_id']] = (
+                total_successful + report['successful_users'] - successful,
+                total_failed + report['failed_users'] - failed,
+            )
+
+        for mailing_id, (successful, failed) in deltas.items():
+            if successful or failed:
+                Mailing.objects.filter(pk=mailing_id).update(
+                    successful_users_count=F('successful_users_count') + successful,
+                    failed_users_count=F('failed_users_count') + failed
+                )
+
+    for report in reports:
+        batch_sent_at = sent_times.get((report['mailing_id'], report['batch_number']))
+        if batch_sent_at is not None:
+            received_at = report.get('received_at', reported_at.timestamp())
+            status_callback_lag_seconds.observe(max(0.0, received_at - batch_sent_at.timestamp()))
+
+    return len(reports)
+
+
+class BatchStatusBuffer:
+    """
+    Буфер отчетов о пакетах от бота.
+
+    Отчеты о том же пакете схлопываются (остается последний), а накопленное
+    записывается через write_batch_reports, когда в буфере BROADCAST_STATUS_BUFFER_SIZE
+    пакетов или прошло BROADCAST_STATUS_FLUSH_INTERVAL секунд.
+
+    write() дожидается записи отчетов: пока одна транзакция пишет буфер,
+    отчеты следующих запросов копятся и записываются следующей одной
+    транзакцией (group commit).
+    """
+
+    def __init__(self, max_size: int = BROADCAST_STATUS_BUFFER_SIZE, flush_interval: float = BROADCAST_STATUS_FLUSH_INTERVAL):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._reports: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, reports: Iterable[Dict[str, Any]]) -> None:
+        with self._lock:
+            for report in reports:
+                key = (report['mailing_id'], report['batch_number'])
+                # Задержка отчета считается по первому полученному отчету о пакете
+                received_at = self._reports[key]['received_at'] if key in self._reports else time.time()
+                self._reports[key] = {**report, 'received_at': received_at}
+                status_reports.inc()
+            full = len(self._reports) >= self.max_size
+            self._ensure_thread()
+
+        if full:
+            self.flush()
+
+    def write(self, reports: Iterable[Dict[str, Any]]) -> None:
+        """
+        Добавляет отчеты и возвращает управление, когда они записаны в базу.
+        Если запись не удалась, отчеты остаются в буфере, а исключение
+        передается вызывающему: бот повторит запрос.
+        """
+        self.add(reports)
+        self.flush()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                reports, self._reports = self._reports, {}
+            try:
+                return write_batch_reports(list(reports.values()))
+            except Exception:
+                # Возвращаем отчеты в буфер, если за это время не пришли более новые
+                with self._lock:
+                    for key, report in reports.items():
+                        self._reports.setdefault(key, report)
+                raise
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='broadcast-status-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Ошибка записи статусов пакетов: %s", e)
+            finally:
+                close_old_connections()
+
+
+status_buffer = BatchStatusBuffer()
+atexit.register(status_buffer.flush)
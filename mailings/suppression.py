@@ -0,0 +1,108 @@
+import bisect
+import threading
+import time
+from array import array
+from datetime import timedelta
+from typing import Iterable
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import MailingFailure, PERMANENT_DELIVERY_ERRORS, SuppressedUser
+
+# Исключать ли из рассылок пользователей с постоянными ошибками доставки
+MAILING_SUPPRESSION_ENABLED = getattr(settings, 'MAILING_SUPPRESSION_ENABLED', True)
+# За сколько дней учитываются ошибки: по истечении окна пользователю снова пробуют отправить
+MAILING_SUPPRESSION_WINDOW_DAYS = getattr(settings, 'MAILING_SUPPRESSION_WINDOW_DAYS', 30)
+# Не чаще какого интервала перестраивать список (секунды)
+MAILING_SUPPRESSION_REFRESH_INTERVAL = getattr(settings, 'MAILING_SUPPRESSION_REFRESH_INTERVAL', 60)
+
+
+def suppress_failures(failures: Iterable[MailingFailure], failed_at=None, keep_existing: bool = False) -> int:
+    """
+    Заносит пользователей с постоянными ошибками доставки в SuppressedUser
+    (время ошибки - failed_at или текущее). Если пользователь уже в таблице,
+    его запись заменяется, а при keep_existing остается прежней
+    (так переносятся старые ошибки, которые не новее записанных).
+
+    Returns:
+        int: количество пользователей с постоянными ошибками
+    """
+    failed_at = failed_at or timezone.now()
+    users = {
+        failure.user_id: SuppressedUser(user_id=failure.user_id, error_code=failure.error_code, failed_at=failed_at)
+        for failure in failures
+        if failure.error_code in PERMANENT_DELIVERY_ERRORS
+    }
+    if not users:
+        return 0
+    if keep_existing:
+        SuppressedUser.objects.bulk_create(users.values(), batch_size=1000, ignore_conflicts=True)
+    else:
+        SuppressedUser.objects.bulk_create(
+            users.values(),
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['user_id'],
+            update_fields=['error_code', 'failed_at'],
+        )
+    return len(users)
+
+
+class SuppressionList:
+    """
+    Пользователи, доставка которым заведомо невозможна: заблокировали бота,
+    удалили аккаунт, чат не найден (PERMANENT_DELIVERY_ERRORS).
+
+    Список перестраивается по SuppressedUser за последние window_days дней,
+    поэтому пользователь выходит из него, когда его ошибка устаревает
+    (или запись удалена вручную), но не при перезапуске рассылки.
+    В памяти хранится отсортированный array('q') (8 байт на пользователя),
+    принадлежность проверяется двоичным поиском.
+    """
+
+    def __init__(
+        self,
+        window_days: float = MAILING_SUPPRESSION_WINDOW_DAYS,
+        refresh_interval: float = MAILING_SUPPRESSION_REFRESH_INTERVAL
+    ):
+        self.window_days = window_days
+        self.refresh_interval = refresh_interval
+        self._ids = array('q')
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        Перестраивает список, если с прошлого раза прошло refresh_interval секунд.
+
+        Returns:
+            int: количество пользователей в списке
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._refreshed_at is not None and now - self._refreshed_at < self.refresh_interval:
+                return len(self._ids)
+
+            rows = SuppressedUser.objects.filter(
+                failed_at__gte=timezone.now() - timedelta(days=self.window_days)
+            ).order_by('user_id').values_list('user_id', flat=True)
+
+            self._ids = array('q', rows.iterator(chunk_size=10000))
+            self._refreshed_at = now
+            return len(self._ids)
+
+    def __contains__(self, user_id) -> bool:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return False
+        ids = self._ids
+        index = bisect.bisect_left(ids, user_id)
+        return index < len(ids) and ids[index] == user_id
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+suppression_list = SuppressionList()
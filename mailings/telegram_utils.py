@@ -38,6 +38,16 @@ def create_text_message(mailing) -> Dict[str, Any]:
     return message
 
 
+def media_source(media) -> str:
+    """
+    Что передавать боту в поле media: file_id уже загруженного в Telegram файла
+    или путь к файлу, если файл еще не загружался.
+    """
+    if media.telegram_file_id:
+        return media.telegram_file_id
+    return f"{settings.BOT_BASE_DIR}/media/{media.file}"
+
+
 def prepare_media_messages(media_files) -> List[Dict[str, Any]]:
     """
     Подготовка медиа-сообщений для отправки в Telegram
@@ -77,7 +87,8 @@ def prepare_media_messages(media_files) -> List[Dict[str, Any]]:
 
             media_item = {
                 "type": media.media_type,
-                "media": f"{settings.BOT_BASE_DIR}/media/{media.file}"
+                "media": media_source(media),
+                "media_id": media.pk
             }
             if media.caption:
                 media_item["caption"] = media.caption
@@ -97,7 +108,8 @@ def prepare_media_messages(media_files) -> List[Dict[str, Any]]:
 
             messages.append({
                 "type": media.media_type,
-                "media": f"{settings.BOT_BASE_DIR}/media/{media.file}",
+                "media": media_source(media),
+                "media_id": media.pk,
                 **base_params
             })
 
@@ -0,0 +1,217 @@
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import dispatcher, id_store
+from .batch_sizer import AdaptiveBatchSize
+from .fair_queue import FairQueue, TokenBucket
+from .frequency import DeliveryIndex, save_batch_ids
+from .models import DeliveryError, Mailing, MailingBatch, SuppressedUser
+from .snapshot import AudienceSnapshot
+from .status_buffer import write_batch_reports
+from .suppression import SuppressionList
+
+
+class MailingClaimTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='mailing-tests')
+
+    def create_mailing(self, **fields):
+        return Mailing.objects.create(
+            title='Тест',
+            text='Тест',
+            scheduled_at=timezone.now() - timedelta(minutes=1),
+            created_by=self.user,
+            **fields
+        )
+
+    def test_processing_without_lease_is_claimable(self):
+        # Так рассылки оставлял обработчик до появления аренд
+        mailing = self.create_mailing(status=Mailing.Status.PROCESSING)
+        self.assertIsNone(mailing.lease_expires_at)
+
+        claimed = Mailing.objects.claim('worker', lease_seconds=60)
+
+        self.assertEqual([m.pk for m in claimed], [mailing.pk])
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.lease_owner, 'worker')
+        self.assertIsNotNone(mailing.lease_expires_at)
+
+    def test_processing_with_live_lease_is_not_claimable(self):
+        self.create_mailing(
+            status=Mailing.Status.PROCESSING,
+            lease_owner='other',
+            lease_expires_at=timezone.now() + timedelta(minutes=1)
+        )
+
+        self.assertEqual(Mailing.objects.claim('worker', lease_seconds=60), [])
+
+    def test_processing_with_expired_lease_is_claimable(self):
+        mailing = self.create_mailing(
+            status=Mailing.Status.PROCESSING,
+            lease_owner='other',
+            lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        self.assertEqual([m.pk for m in Mailing.objects.claim('worker', lease_seconds=60)], [mailing.pk])
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+
+@override_settings(BROADCAST_URL='http://bot')
+class BroadcastErrorTests(TransactionTestCase):
+    def setUp(self):
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir, ignore_errors=True)
+        patcher = mock.patch.object(id_store, 'MAILING_DATA_DIR', data_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(dispatcher, 'MAILING_BROADCAST_RETRY_BACKOFF', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        user = get_user_model().objects.create(username='mailing-tests')
+        self.mailing = Mailing.objects.create(
+            title='Тест', text='Тест', scheduled_at=timezone.now(), created_by=user
+        )
+        self.snapshot = AudienceSnapshot.for_mailing(self.mailing.pk)
+        self.snapshot.build([list(range(1, 1001))])
+
+    def test_server_error_shrinks_batch_and_mailing_continues(self):
+        sizer = AdaptiveBatchSize(initial=200, minimum=10, step=0, decrease=0.5)
+        queue = FairQueue(bucket=TokenBucket(rate=0), senders=1)
+        responses = iter([_Response(503)])
+        received = []
+
+        def post(url, data=None, **kwargs):
+            response = next(responses, None)
+            if response is not None:
+                return response
+            received.append(data)
+            return _Response(200)
+
+        with mock.patch.object(dispatcher.http_client, 'post', side_effect=post), \
+                mock.patch.object(dispatcher.http_client, 'put', return_value=_Response(204)):
+            total_users, completed = dispatcher.dispatch_mailing(
+                self.mailing,
+                dispatcher.get_mailing_data(self.mailing),
+                self.snapshot,
+                sizer=sizer,
+                fair_queue=queue
+            )
+
+        self.assertTrue(completed)
+        self.assertEqual(total_users, 1000)
+        self.assertEqual(sizer.size, 100)
+        # Пакет, получивший 503, повторен и принят
+        self.assertEqual(len(received), self.mailing.batches.count())
+
+
+class DeliveryIndexTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        user = get_user_model().objects.create(username='mailing-tests')
+        self.mailing = Mailing.objects.create(
+            title='Тест', text='Тест', scheduled_at=timezone.now(), created_by=user
+        )
+
+    def report(self, error_details=()):
+        return {
+            'mailing_id': self.mailing.pk,
+            'batch_number': 1,
+            'successful_users': 3 - len(error_details),
+            'failed_users': len(error_details),
+            'error_details': list(error_details),
+        }
+
+    def test_reported_batch_is_recorded_from_database(self):
+        # Состав пакета пишет обработчик, отчет принимает веб-процесс:
+        # общего каталога у них может не быть
+        index = DeliveryIndex(cap=1, directory=self.directory)
+        save_batch_ids(self.mailing.pk, 1, ['1', '2', '3'])
+        write_batch_reports([self.report([{'user_id': '2', 'error': 'Forbidden: bot was blocked by the user'}])])
+
+        self.assertEqual(index.record_reported_batches(), 2)
+        index.refresh(force=True)
+        self.assertIn(1, index)
+        self.assertNotIn(2, index)
+        self.assertIsNone(MailingBatch.objects.get(mailing=self.mailing).user_ids)
+
+        # Повторный отчет о пакете доставки не удваивает
+        write_batch_reports([self.report()])
+        self.assertEqual(index.record_reported_batches(), 0)
+
+    def test_batch_without_report_is_not_recorded(self):
+        index = DeliveryIndex(cap=1, directory=self.directory)
+        save_batch_ids(self.mailing.pk, 1, ['1', '2', '3'])
+
+        self.assertEqual(index.record_reported_batches(), 0)
+
+
+class SuppressionListTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create(username='mailing-tests')
+        self.mailing = Mailing.objects.create(
+            title='Тест', text='Тест', scheduled_at=timezone.now(), created_by=user
+        )
+
+    def test_blocked_user_stays_suppressed_after_restart(self):
+        write_batch_reports([{
+            'mailing_id': self.mailing.pk,
+            'batch_number': 1,
+            'successful_users': 1,
+            'failed_users': 2,
+            'error_details': [
+                {'user_id': '7', 'error': 'Forbidden: bot was blocked by the user'},
+                {'user_id': '9', 'error': 'Too Many Requests'},
+            ],
+        }])
+        self.mailing.restart()
+
+        suppression = SuppressionList()
+        self.assertEqual(suppression.refresh(force=True), 1)
+        self.assertIn('7', suppression)
+        self.assertNotIn(9, suppression)
+        self.assertNotIn('не число', suppression)
+
+    def test_old_failure_leaves_list(self):
+        SuppressedUser.objects.create(
+            user_id=7, error_code=DeliveryError.BOT_BLOCKED, failed_at=timezone.now() - timedelta(days=31)
+        )
+
+        self.assertEqual(SuppressionList(window_days=30).refresh(force=True), 0)
+
+
+@override_settings(BROADCAST_TOKEN='token')
+class BroadcastStatusBulkViewTests(TestCase):
+    def test_reports_are_saved_before_response_and_unknown_mailings_rejected(self):
+        user = get_user_model().objects.create(username='mailing-tests')
+        mailing = Mailing.objects.create(title='Тест', text='Тест', scheduled_at=timezone.now(), created_by=user)
+
+        response = self.client.post(
+            reverse('broadcast-status-bulk'),
+            [
+                {'broadcast_id': mailing.pk, 'batch_number': 1, 'successful_users': 5},
+                {'broadcast_id': mailing.pk + 1000, 'batch_number': 1, 'successful_users': 5},
+                {'broadcast_id': mailing.pk},
+            ],
+            content_type='application/json',
+            HTTP_AUTHORIZATION='token'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['accepted'], 1)
+        self.assertEqual(response.json()['rejected'], 2)
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.successful_users_count, 5)
@@ -3,4 +3,6 @@ from . import views
 
 urlpatterns = [
     path('status', views.BroadcastStatusView.as_view(), name='broadcast-status'),
+    path('status/bulk', views.BroadcastStatusBulkView.as_view(), name='broadcast-status-bulk'),
+    path('media', views.BroadcastMediaView.as_view(), name='broadcast-media'),
 ]
@@ -3,37 +3,141 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.exceptions import AuthenticationFailed
 from django.conf import settings
-from .models import MailingBatch, Mailing
-from django.shortcuts import get_object_or_404
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.views import View
+from .models import Mailing, MailingMedia
+from .status_buffer import status_buffer
+from . import metrics
+
+
+def check_broadcast_token(request):
+    # Проверяем токен из заголовка
+    token = request.headers.get('Authorization')
+    if not token or token != settings.BROADCAST_TOKEN:
+        raise AuthenticationFailed('Неверный токен авторизации')
+
+
+def parse_batch_report(data):
+    """
+    Приводит отчет бота о пакете к виду, который пишет status_buffer.
+    Возвращает None, если в отчете нет номера пакета или рассылки.
+    """
+    try:
+        return {
+            'mailing_id': int(data.get('broadcast_id')),
+            'batch_number': int(data.get('batch_number')),
+            'successful_users': int(data.get('successful_users') or 0),
+            'failed_users': int(data.get('failed_users') or 0),
+            'error_details': data.get('error_details') or [],
+        }
+    except (AttributeError, TypeError, ValueError):
+        return None
+
 
 class BroadcastStatusView(APIView):
     def post(self, request):
-        # Проверяем токен из заголовка
-        token = request.headers.get('Authorization')
-        if not token or token != settings.BROADCAST_TOKEN:
-            raise AuthenticationFailed('Неверный токен авторизации')
-            
-        batch_number = request.data.get('batch_number')
-        broadcast_id = request.data.get('broadcast_id')
-        successful_users = request.data.get('successful_users', 0)
-        failed_users = request.data.get('failed_users', 0)
-        error_details = request.data.get('error_details', [])
+        check_broadcast_token(request)
 
-        try:
-            mailing = Mailing.objects.get(pk=broadcast_id)
-        except Mailing.DoesNotExist:
+        report = parse_batch_report(request.data)
+        if report is None:
+            return Response(
+                {'error': 'Не указаны batch_number или broadcast_id'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not Mailing.objects.filter(pk=report['mailing_id']).exists():
             return Response(
                 {'error': 'Рассылка не найдена'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        batch, created = MailingBatch.objects.update_or_create(
-            mailing=mailing,
-            batch_number=batch_number,
-            defaults={
-                'successful_users': successful_users,
-                'failed_users': failed_users,
-                'error_details': error_details
-            }
+        try:
+            status_buffer.write([report])
+        except DatabaseError:
+            return Response({'error': 'Отчет не сохранен, повторите запрос'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+
+
+class BroadcastStatusBulkView(APIView):
+    """
+    Прием отчетов сразу о нескольких пакетах: список отчетов в формате
+    /status или объект {"batches": [...]}. Ответ отправляется после записи
+    отчетов в базу; отчеты без номера пакета или по несуществующим
+    рассылкам не записываются и считаются в rejected.
+    """
+
+    def post(self, request):
+        check_broadcast_token(request)
+
+        items = request.data
+        if isinstance(items, dict):
+            items = items.get('batches')
+        if not isinstance(items, list):
+            return Response(
+                {'error': 'Ожидается список отчетов о пакетах'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        reports = [report for report in map(parse_batch_report, items) if report is not None]
+        existing_ids = set(Mailing.objects.filter(
+            pk__in={report['mailing_id'] for report in reports}
+        ).values_list('pk', flat=True))
+        reports = [report for report in reports if report['mailing_id'] in existing_ids]
+        try:
+            status_buffer.write(reports)
+        except DatabaseError:
+            return Response({'error': 'Отчеты не сохранены, повторите запрос'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(
+            {'status': 'ok', 'accepted': len(reports), 'rejected': len(items) - len(reports)},
+            status=status.HTTP_200_OK
         )
-        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
\ No newline at end of file
+
+
+class BroadcastMediaView(APIView):
+    """
+    Бот сообщает file_id загруженных в Telegram медиафайлов:
+    {"media_id": 12, "file_id": "..."} или список таких объектов.
+    file_id сохраняется для всех медиафайлов с тем же содержимым и типом.
+    """
+
+    def post(self, request):
+        check_broadcast_token(request)
+
+        items = request.data if isinstance(request.data, list) else [request.data]
+        updated = 0
+        for item in items:
+            if not isinstance(item, dict) or not item.get('file_id'):
+                continue
+            try:
+                media_id = int(item.get('media_id'))
+            except (TypeError, ValueError):
+                continue
+            media = MailingMedia.objects.filter(pk=media_id).only('content_hash', 'media_type').first()
+            if media is None:
+                continue
+
+            same_content = MailingMedia.objects.filter(pk=media.pk)
+            if media.content_hash:
+                same_content = MailingMedia.objects.filter(
+                    content_hash=media.content_hash,
+                    media_type=media.media_type
+                )
+            updated += same_content.update(telegram_file_id=str(item['file_id'])[:255])
+
+        return Response({'status': 'ok', 'updated': updated}, status=status.HTTP_200_OK)
+
+
+class MetricsView(View):
+    """
+    Метрики обработчика рассылок и приема отчетов в формате Prometheus.
+    Если задан METRICS_TOKEN, он должен быть передан в заголовке Authorization.
+    Метрики собираются в памяти процесса, поэтому отдельно запущенный
+    check_mailings здесь не виден.
+    """
+
+    def get(self, request):
+        token = getattr(settings, 'METRICS_TOKEN', None)
+        if token and request.headers.get('Authorization') != token:
+            return HttpResponse('Неверный токен авторизации', status=401, content_type='text/plain; charset=utf-8')
+        return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)